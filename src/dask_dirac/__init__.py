@@ -6,7 +6,8 @@ dask-dirac: DIRAC Executor for Dask
 
 from __future__ import annotations
 
-from ._dask import DiracClient, DiracCluster
+from ._cache import DiracClient
+from ._dask import DiracCluster
 from ._version import get_versions
 
 __version__ = get_versions()["version"]
@@ -0,0 +1,866 @@
+"""Result cache of a DiracClient
+
+Task results are stored under a hash of the task and of all of its inputs,
+either in a local directory (file://) or on grid storage (dirac://), and
+tasks whose result is already cached are replaced by a load of that result.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import uuid
+from collections.abc import Callable, Collection, Iterator, Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any
+
+import dask.config
+import dask.core
+from dask.base import tokenize
+from dask.distributed import Client, get_worker
+from dask.highlevelgraph import HighLevelGraph, MaterializedLayer
+from dask.utils import Dispatch, key_split, parse_bytes
+from distributed.diagnostics.plugin import WorkerPlugin
+
+from . import _dirac
+from ._serializers import (
+    PANDAS_PARQUET,
+    PICKLE,
+    Serializer,
+    is_cache_file,
+    serializer_for,
+    serializer_for_file,
+    split_cache_file_name,
+)
+
+logger = logging.getLogger(__name__)
+
+CACHE_MANIFEST = "manifest.jsonl"
+DIRAC_CACHE_SHARDS = 256
+
+
+class DiracClient(Client):
+    """Client for caching dask computations
+
+    ``cache_layers`` restricts caching to the high level graph layers whose
+    name (as given by ``dask.utils.key_split``) is in the collection, or for
+    which the callable returns True. By default every layer is cached. Layers
+    that are not cached are passed on untouched, so they are not materialized
+    on the client. Tasks that depend on the results of uncached layers are
+    not cached either, as their inputs are not hashed. With
+    ``hash_uncached_by_name=True`` the keys of uncached tasks stand in for
+    their results instead; only use it if those keys change whenever the
+    results do, which is not the case for user-chosen names such as
+    ``da.from_array(x, name="input")``.
+
+    With ``write_behind=True`` a ``CacheWriter`` plugin is registered on the
+    workers, so that cache writes happen in the background instead of
+    delaying downstream tasks. Asynchronous clients have to register the
+    plugin themselves.
+
+    With ``memory_map_loads=True`` cache hits on local Arrow IPC and npy
+    files are memory-mapped rather than read; the loaded data is read-only.
+
+    ``dirac_settings`` are used to list a dirac:// cache location. By default
+    they are taken from the environment (see ``settings_from_environment``).
+    Only their server URL is passed on to the tasks that read and write the
+    cache: workers use the proxy and CA directory of their own environment.
+    Queries share the keep-alive connections of the ``DiracHTTPClient``.
+    """
+
+    def __init__(  # type: ignore[no-untyped-def]
+        self,
+        *args,
+        cache_location: str = "file:///tmp/dask-dirac-cache",
+        cache_layers: Callable[[str], bool] | Collection[str] | None = None,
+        write_behind: bool = False,
+        memory_map_loads: bool = False,
+        dirac_settings: _dirac.DiracSettings | None = None,
+        hash_uncached_by_name: bool = False,
+        **kwargs,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.cache_location = cache_location
+        self.cache_layers = cache_layers
+        self.hash_uncached_by_name = hash_uncached_by_name
+        self.memory_map_loads = memory_map_loads
+        if dirac_settings is None and cache_location.startswith("dirac://"):
+            dirac_settings = _dirac.settings_from_environment()
+        self.dirac_settings = dirac_settings
+        if write_behind:
+            if self.asynchronous:
+                raise ValueError(
+                    "write_behind is not supported for asynchronous clients, "
+                    "use `await client.register_plugin(CacheWriter())` instead"
+                )
+            self.register_plugin(CacheWriter())
+
+    def _should_cache_layer(self, layer_name: str) -> bool:
+        if self.cache_layers is None:
+            return True
+        if callable(self.cache_layers):
+            return self.cache_layers(layer_name)
+        return key_split(layer_name) in self.cache_layers
+
+    def _graph_to_futures(
+        self,
+        dsk: dict[str, Any] | HighLevelGraph,
+        *args: dict[str, Any],
+        **kwargs: dict[str, Any],
+    ) -> Any:
+        if not isinstance(dsk, HighLevelGraph):
+            dsk = HighLevelGraph.from_collections(str(id(dsk)), dsk, dependencies=())
+
+        # list the cache once for the whole graph instead of once per task
+        cache_index = CacheIndex(self.cache_location, self.dirac_settings)
+
+        # Hashes of keys of earlier layers. Tasks of layers that are not cached
+        # are not hashed: their results, and those of the tasks that depend on
+        # them, are not cached unless their keys stand in for the content
+        hashes: dict[Any, str] = {}
+        unhashed: set[Any] = set()
+        layers: dict[str, Any] = {}
+        for layer_name in dsk._toposort_layers():  # pylint: disable=protected-access
+            layer = dsk.layers[layer_name]
+            if not self._should_cache_layer(layer_name):
+                logging.debug("Not caching layer %s", layer_name)
+                layers[layer_name] = layer
+                if self.hash_uncached_by_name:
+                    hashes.update(
+                        (key, hash_token(key)) for key in layer.get_output_keys()
+                    )
+                else:
+                    unhashed.update(layer.get_output_keys())
+                continue
+
+            info = dict(layer)
+            logging.debug("Checking layer %s:\n%s", layer_name, info)
+            if unhashed:
+                for key in dask.core.toposort(info):
+                    if dask.core.keys_in_tasks(unhashed, [info[key]]):
+                        unhashed.add(key)
+            _, hash_tuples = hash_graph(info, hashes)
+            logging.debug("---------\nHashes: %s\n---------", hash_tuples)
+
+            # Now check tasks that need to be checked, adding caching
+            tasks = {}
+            for key, value in info.items():
+                if key in unhashed:
+                    logging.debug("Not caching %s, its inputs are not hashed", key)
+                    tasks[key] = value
+                    continue
+                if key not in hash_tuples:
+                    logging.debug("Not processing alias %s", key)
+                    tasks[key] = value
+                    continue
+                tasks[key] = check_functions_and_hashes(
+                    value,
+                    hash_tuples[key],
+                    self.cache_location,
+                    cache_index,
+                    self.memory_map_loads,
+                )
+                logging.debug("final_function_tuple for %s:\n%s", key, tasks[key])
+
+            layers[layer_name] = MaterializedLayer(tasks, annotations=layer.annotations)
+
+        dsk = HighLevelGraph(layers, dsk.dependencies)
+
+        return super()._graph_to_futures(dsk, *args, **kwargs)
+
+
+class CacheWriter(WorkerPlugin):
+    """Worker plugin that writes cache entries in the background
+
+    With this plugin registered, ``save_to_cache`` returns the result of a
+    task straight away and hands the write over to a pool of ``nthreads``
+    threads. At most ``max_pending`` writes are queued, further tasks block
+    until a slot is free. Pending writes are flushed when the worker closes.
+    Results must not be modified in place by downstream tasks while they are
+    being written.
+    """
+
+    name = "dask-dirac-cache-writer"
+
+    def __init__(self, nthreads: int = 1, max_pending: int = 16) -> None:
+        self.nthreads = nthreads
+        self.max_pending = max_pending
+        self._executor: ThreadPoolExecutor | None = None
+        self._slots: threading.BoundedSemaphore | None = None
+
+    def setup(self, worker: Any) -> None:
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = ThreadPoolExecutor(
+            self.nthreads, thread_name_prefix="dask-dirac-cache-writer"
+        )
+
+    def teardown(self, worker: Any) -> None:
+        self.flush()
+
+    def submit(self, func: Callable[..., Any], *args: Any) -> None:
+        """Run ``func(*args)`` in the background"""
+        if self._executor is None or self._slots is None:
+            raise RuntimeError("CacheWriter has not been set up")
+        self._slots.acquire()  # pylint: disable=consider-using-with
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._done)
+
+    def flush(self) -> None:
+        """Wait for all pending writes and stop the writer threads"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _done(self, future: Future[Any]) -> None:
+        self._slots.release()  # type: ignore[union-attr]
+        if future.exception() is not None:
+            logger.error("Failed to write cache entry", exc_info=future.exception())
+
+
+def _get_cache_writer() -> CacheWriter | None:
+    try:
+        worker = get_worker()
+    except ValueError:
+        return None
+    writer = worker.plugins.get(CacheWriter.name)
+    return writer if isinstance(writer, CacheWriter) else None
+
+
+class CacheIndex:
+    """Index of the entries available at a cache location
+
+    The cache location is listed once, when the index is created or refreshed,
+    and lookups are then answered from an in-memory dictionary of entry names
+    to file names. ``dirac_settings`` are used for dirac:// locations and
+    their server URL is passed on to the tasks that read and write the cache.
+
+    The manifest of a file:// location may list files that have since been
+    deleted, so the file of an entry is checked to exist the first time the
+    entry is looked up. Missing entries are dropped and recomputed.
+    """
+
+    def __init__(
+        self, cache_location: str, dirac_settings: _dirac.DiracSettings | None = None
+    ) -> None:
+        self.cache_location = cache_location
+        self.dirac_settings = dirac_settings
+        self._entries: dict[str, str] = {}
+        self._checked: set[str] = set()
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Re-read the list of cached entries from the cache location"""
+        self._entries = get_cache_entries(self.cache_location, self.dirac_settings)
+        self._checked = set()
+        logging.debug(
+            "Cache index for %s holds %d entries",
+            self.cache_location,
+            len(self._entries),
+        )
+
+    def file_name(self, entry: str) -> str:
+        """File name, including the extension, of a cached entry"""
+        return self._entries[entry]
+
+    def __contains__(self, entry: object) -> bool:
+        if not isinstance(entry, str) or entry not in self._entries:
+            return False
+        if entry in self._checked or not self.cache_location.startswith("file://"):
+            return True
+        path = os.path.join(self.cache_location[len("file://") :], self._entries[entry])
+        if not os.path.exists(path):
+            logging.debug("Cache entry %s is gone, recomputing it", entry)
+            del self._entries[entry]
+            return False
+        self._checked.add(entry)
+        return True
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def hash_graph(
+    graph: Mapping[Any, Any], hashes: dict[Any, str] | None = None
+) -> tuple[dict[Any, str], dict[Any, Any]]:
+    """Hash every task of a materialized graph
+
+    Tasks are visited once, in topological order, so the hash of every
+    dependency is already known and is substituted for its key (Merkle-style).
+    ``hashes`` may hold the hashes of keys outside of ``graph``, e.g. of
+    earlier layers of a high level graph, and is updated in place.
+    Returns the top-level hash of each key and the nested hash tuple of each
+    task; keys that are aliases of other keys only appear in the former.
+    """
+    if hashes is None:
+        hashes = {}
+    hash_tuples: dict[Any, Any] = {}
+    token_cache: dict[int, Any] = {}
+    for key in dask.core.toposort(graph):
+        value = graph[key]
+        logging.debug("Key: %s, Value: %s", key, value)
+        if dask.core.ishashable(value) and value in hashes:
+            # alias of another key, e.g. the output of a collection
+            hashes[key] = hashes[value]
+            continue
+        hashes[key], hash_tuples[key] = generate_hash_from_value(
+            _substitute_hashes(value, hashes), token_cache
+        )
+    return hashes, hash_tuples
+
+
+def _substitute_hashes(value: Any, hashes: dict[Any, str]) -> Any:
+    """Replace references to already hashed keys in a task by their hashes"""
+    if dask.core.ishashable(value) and value in hashes:
+        return hashes[value]
+    if isinstance(value, (tuple, list)):
+        return type(value)(_substitute_hashes(item, hashes) for item in value)
+    return value
+
+
+def check_functions_and_hashes(
+    func_tuple: Any,
+    hash_tuple: Any,
+    cache_location: str,
+    cached_files: CacheIndex | None = None,
+    memory_map: bool = False,
+) -> Any:
+    """Check if functions and hashes exist in cache
+
+    ``cached_files`` should be shared between calls, otherwise the cache
+    location is listed on every call. ``memory_map`` is passed on to
+    ``load_from_cache``.
+    """
+    logging.debug("Checking func_tuple: %s", func_tuple)
+    logging.debug("Checking hash_tuple: %s", hash_tuple)
+
+    if cached_files is None:
+        cached_files = CacheIndex(cache_location)
+
+    if len(func_tuple) > 2:
+        logging.debug(
+            "Need to think about how to do this, but for now just check first hash"
+        )
+        if hash_tuple[0] in cached_files:
+            return _load_task(hash_tuple[0], cache_location, cached_files, memory_map)
+        return _save_task(hash_tuple[0], func_tuple, cache_location, cached_files)
+
+    # Get to the deepest level and replace
+    if isinstance(hash_tuple, tuple) and isinstance(func_tuple, tuple):
+        current_hash, nested_hash = hash_tuple
+        current_func, nested_func = func_tuple
+
+        if current_hash in cached_files:
+            return _load_task(current_hash, cache_location, cached_files, memory_map)
+        # Recursively process the nested tuple
+        modified_nested_func = check_functions_and_hashes(
+            nested_func, nested_hash, cache_location, cached_files, memory_map
+        )
+        return _save_task(
+            current_hash,
+            (current_func, modified_nested_func),
+            cache_location,
+            cached_files,
+        )
+
+    # Base case: No more nested tuples
+    if hash_tuple in cached_files:
+        return _load_task(hash_tuple, cache_location, cached_files, memory_map)
+    return _save_task(hash_tuple, func_tuple, cache_location, cached_files)
+
+
+def _load_task(
+    entry: str, cache_location: str, cached_files: CacheIndex, memory_map: bool
+) -> tuple[Any, ...]:
+    task: tuple[Any, ...] = (
+        load_from_cache,
+        cached_files.file_name(entry),
+        cache_location,
+        memory_map,
+    )
+    if cached_files.dirac_settings is not None:
+        task += (cached_files.dirac_settings.server_url,)
+    return task
+
+
+def _save_task(
+    entry: str, func_tuple: Any, cache_location: str, cached_files: CacheIndex
+) -> tuple[Any, ...]:
+    task: tuple[Any, ...] = (save_to_cache, entry, func_tuple, cache_location)
+    if cached_files.dirac_settings is not None:
+        task += (cached_files.dirac_settings.server_url,)
+    return task
+
+
+normalize_for_hash = Dispatch(name="normalize_for_hash")
+
+
+@normalize_for_hash.register(object)
+def _normalize_object_for_hash(obj: Any) -> Any:
+    if callable(obj) and not hasattr(obj, "__name__") and hasattr(obj, "file"):
+        # FileMeta objects from the AGC are identified by the file they read
+        # and the rest of their state, e.g. the range of entries to read
+        return type(obj).__qualname__, obj.file, getattr(obj, "__dict__", {})
+    return obj
+
+
+def hash_token(obj: Any) -> str:
+    """Deterministic token of the content of ``obj`` used for cache hashes
+
+    Objects are passed through ``normalize_for_hash`` first and the result is
+    tokenized with ``dask.base.tokenize``, so partials include their bound
+    arguments and numpy arrays and pandas objects are hashed by value.
+    Register extra types with ``normalize_for_hash.register(cls)``.
+    """
+    return tokenize(normalize_for_hash(obj), ensure_deterministic=False)
+
+
+def _cached_hash_token(obj: Any, token_cache: dict[int, Any] | None) -> str:
+    if token_cache is None or not callable(obj):
+        return hash_token(obj)
+    cached = token_cache.get(id(obj))
+    if cached is None:
+        # keep a reference to obj so that its id cannot be reused
+        cached = token_cache[id(obj)] = (obj, hash_token(obj))
+    return cached[1]
+
+
+def generate_hash_from_value(
+    value: tuple[Callable[..., Any]], token_cache: dict[int, Any] | None = None
+) -> tuple[str, Any]:
+    """Generate hash from value
+
+    ``token_cache`` memoizes the tokens of callables, which are shared by
+    many tasks of the same graph.
+    """
+    if isinstance(value, tuple):
+        this_tuple = None
+
+        # Catch when there is no left and right as at end of chain
+        if len(value) == 1:
+            left = value[0]
+            right = ""
+        else:
+            left = value[0]
+            right = value[1:]
+            if len(right) == 1:
+                right = right[0]
+
+        logging.debug("left: %s", left)
+        logging.debug("right: %s", right)
+
+        # Process left side
+        left_name = _cached_hash_token(left, token_cache)
+
+        # Process right side
+        if isinstance(right, tuple):
+            logging.debug("rerunning function...\nleft: %s\nright: %s", left, right)
+            right_hash, this_tuple = generate_hash_from_value(right, token_cache)
+        else:
+            right_hash = _cached_hash_token(right, token_cache)
+
+        # Combine the names/hashes for final hash
+        combined = left_name + right_hash
+        final_hash = hashlib.sha3_384(combined.encode()).hexdigest()
+        # TODO: Integrate with DiracClient
+        if this_tuple is not None:
+            hash_tuple = (final_hash, this_tuple)
+        else:
+            hash_tuple = final_hash
+
+        logging.debug(
+            "hash inputs: %s\nhash inputs: %s + %s\nhash: %s\nhash tuple: %s",
+            value,
+            left_name,
+            right_hash,
+            final_hash,
+            hash_tuple,
+        )
+
+        return final_hash, hash_tuple
+
+    # should in theory never reach here
+    token = hash_token(value)
+    return token, token
+
+
+def save_to_cache(
+    filename: str,
+    data: Any,
+    cache_location: str,
+    dirac_server_url: str | None = None,
+) -> Any:
+    """Save data to the cache and return it unchanged
+
+    The format is chosen by ``serializer_for`` from the type of ``data``.
+    The file is written in the background if the worker has a CacheWriter.
+    dirac:// locations are written with the settings of the environment of
+    the worker for ``dirac_server_url``.
+    """
+
+    logging.debug("Writing stage to: %s/%s", cache_location, filename)
+
+    if not cache_location.startswith(("file://", "dirac://")):
+        # TODO: RUCIO
+        raise NotImplementedError(
+            f"Caching is not implemented yet for {cache_location}"
+        )
+
+    writer = _get_cache_writer()
+    if writer is None:
+        # like a write-behind write, a failed write must not fail the task
+        try:
+            _write_to_cache(filename, data, cache_location, dirac_server_url)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.error("Failed to write cache entry %s", filename, exc_info=True)
+    else:
+        writer.submit(_write_to_cache, filename, data, cache_location, dirac_server_url)
+    return data
+
+
+def _write_to_cache(
+    filename: str,
+    data: Any,
+    cache_location: str,
+    dirac_server_url: str | None = None,
+) -> None:
+    if cache_location.startswith("dirac://"):
+        _upload_to_dirac_cache(
+            filename,
+            data,
+            cache_location[len("dirac://") :],
+            _dirac.settings_from_environment(dirac_server_url),
+        )
+        return
+    cache_location = cache_location[len("file://") :]
+    name, serializer = _dump_cache_file(filename, data, cache_location)
+    _append_to_manifest(
+        cache_location,
+        [_manifest_entry(name, serializer, rows=_number_of_rows(data))],
+    )
+
+
+def _dump_cache_file(
+    filename: str, data: Any, directory: str
+) -> tuple[str, Serializer]:
+    """Serialize ``data`` into ``directory`` and return the path and format"""
+    # make sure the directory exists
+    os.makedirs(directory, exist_ok=True)
+    # write under a hidden name and rename it into place, so that nobody can
+    # pick up a partially written file
+    tmp_name = f"{directory}/.{filename}.{uuid.uuid4().hex}.tmp"
+    serializer = serializer_for(data)
+    try:
+        serializer.dump(data, tmp_name)
+    except Exception:  # pylint: disable=broad-exception-caught
+        if serializer is PICKLE:
+            raise
+        logging.debug(
+            "Could not write %s as %s, using pickle", filename, serializer.name
+        )
+        serializer = PICKLE
+        serializer.dump(data, tmp_name)
+    name = f"{directory}/{filename}{serializer.extension}"
+    os.replace(tmp_name, name)
+    return name, serializer
+
+
+def _dirac_staging_dir(lfn_dir: str) -> str:
+    """Local directory holding copies of the files in a DIRAC cache directory
+
+    Cache entries are named by their content hash, so a local copy never goes
+    stale and doubles as a read-through cache for later loads on this node.
+    The least recently used copies are removed once the directory grows past
+    the ``dirac.staging-limit`` config value.
+    """
+    digest = hashlib.sha1(lfn_dir.encode()).hexdigest()[:8]
+    return os.path.join(tempfile.gettempdir(), "dask-dirac-staging", digest)
+
+
+def _prune_staging_dir(staging_dir: str, keep: str) -> None:
+    """Remove the least recently used files of ``staging_dir`` until it fits
+    in ``dirac.staging-limit``, never removing ``keep``"""
+    limit = parse_bytes(dask.config.get("dirac.staging-limit", "10GiB"))
+    with os.scandir(staging_dir) as entries:
+        files = [
+            (max(stat.st_atime, stat.st_mtime), stat.st_size, entry.path)
+            for entry in entries
+            if entry.is_file() and not entry.name.startswith(".")
+            for stat in (entry.stat(),)
+        ]
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= limit:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # removed by another worker on this node
+            pass
+        total -= size
+
+
+def _dirac_cache_shard(file_name: str) -> str:
+    """Subdirectory of a DIRAC cache directory that holds ``file_name``
+
+    Spreading the entries over DIRAC_CACHE_SHARDS subdirectories keeps the
+    catalog directories small; they are all listed in a single request.
+    """
+    name = split_cache_file_name(file_name)[0]
+    return (
+        f"{int(hashlib.sha1(name.encode()).hexdigest(), 16) % DIRAC_CACHE_SHARDS:02x}"
+    )
+
+
+def _upload_to_dirac_cache(
+    filename: str, data: Any, lfn_dir: str, settings: _dirac.DiracSettings
+) -> None:
+    staging_dir = _dirac_staging_dir(lfn_dir)
+    local_name, _ = _dump_cache_file(filename, data, staging_dir)
+    file_name = os.path.basename(local_name)
+    lfn = f"{lfn_dir}/{_dirac_cache_shard(file_name)}/{file_name}"
+    try:
+        result = _dirac.add_file(settings, local_name, lfn, overwrite=False)
+    finally:
+        _prune_staging_dir(staging_dir, keep=local_name)
+    if not result.get("OK", False):
+        logger.error("Could not register %s: %s", lfn, result)
+
+
+def _download_from_dirac_cache(
+    file_name: str, lfn_dir: str, settings: _dirac.DiracSettings
+) -> str:
+    """Download the cache file ``file_name``, which is relative to ``lfn_dir``
+    and may include its shard, and return the local copy"""
+    staging_dir = _dirac_staging_dir(lfn_dir)
+    base_name = os.path.basename(file_name)
+    local_name = f"{staging_dir}/{base_name}"
+    if not os.path.exists(local_name):
+        os.makedirs(staging_dir, exist_ok=True)
+        tmp_name = f"{staging_dir}/.{base_name}.{uuid.uuid4().hex}.tmp"
+        _dirac.download_file(settings, f"{lfn_dir}/{file_name}", tmp_name)
+        os.replace(tmp_name, local_name)
+        _prune_staging_dir(staging_dir, keep=local_name)
+    return local_name
+
+
+def _number_of_rows(data: Any) -> int | None:
+    try:
+        return len(data)
+    except TypeError:
+        return None
+
+
+def load_from_cache(
+    file_name: str,
+    cache_location: str,
+    memory_map: bool = False,
+    dirac_server_url: str | None = None,
+) -> Any:
+    """Load data from a cache file
+
+    ``file_name`` includes the extension, which selects the serializer.
+    With ``memory_map``, formats that support it (Arrow IPC, npy) are mapped
+    into memory instead of read: the data is paged in when it is accessed,
+    is shared between processes on the same node and is read-only.
+    dirac:// locations are read with the settings of the environment of the
+    worker for ``dirac_server_url``.
+    """
+    logging.debug("Loading cached file: %s/%s", cache_location, file_name)
+
+    if cache_location.startswith("file://"):
+        path = f"{cache_location[len('file://') :]}/{file_name}"
+    elif cache_location.startswith("dirac://"):
+        path = _download_from_dirac_cache(
+            file_name,
+            cache_location[len("dirac://") :],
+            _dirac.settings_from_environment(dirac_server_url),
+        )
+    else:
+        # TODO: RUCIO
+        raise NotImplementedError(
+            f"Caching is not implemented yet for {cache_location}"
+        )
+
+    serializer = serializer_for_file(os.path.basename(file_name))
+    load = serializer.load
+    if memory_map and serializer.load_mapped is not None:
+        load = serializer.load_mapped
+    return load(path)
+
+
+def _manifest_entry(
+    path: str, serializer: Serializer, rows: int | None = None
+) -> dict[str, Any]:
+    file_name = os.path.basename(path)
+    stat = os.stat(path)
+    return {
+        "name": split_cache_file_name(file_name)[0],
+        "file": file_name,
+        "format": serializer.name,
+        "size": stat.st_size,
+        "rows": rows,
+        "created": stat.st_mtime,
+    }
+
+
+def _list_cache_dir(cache_dir: str) -> dict[str, str]:
+    """Map entry names to file names by listing a local cache directory"""
+    with os.scandir(cache_dir) as entries:
+        return {
+            split_cache_file_name(entry.name)[0]: entry.name
+            for entry in entries
+            if entry.is_file()
+            and not entry.name.startswith(".")
+            and is_cache_file(entry.name)
+        }
+
+
+@contextlib.contextmanager
+def _manifest_lock(cache_dir: str) -> Iterator[None]:
+    """Hold the lock on the manifest of a local cache directory
+
+    O_APPEND writes are only atomic on local file systems; on NFS every
+    client computes the end of the file itself and concurrent appends can
+    overwrite each other. fcntl locks are honoured by NFS, and taking one also
+    makes the client revalidate its view of the manifest.
+    """
+    lock = os.path.join(cache_dir, f".{CACHE_MANIFEST}.lock")
+    file_descriptor = os.open(lock, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.lockf(file_descriptor, fcntl.LOCK_EX)
+        yield
+    finally:
+        # closing the file releases the lock
+        os.close(file_descriptor)
+
+
+def _append_to_manifest(cache_dir: str, entries: list[dict[str, Any]]) -> None:
+    """Append entries to the manifest of a local cache directory
+
+    Each entry is one JSON line, written while holding the manifest lock.
+    A missing manifest is first seeded from the files already present.
+    """
+    manifest = os.path.join(cache_dir, CACHE_MANIFEST)
+    with _manifest_lock(cache_dir):
+        if not os.path.exists(manifest):
+            new_names = {entry["name"] for entry in entries}
+            existing = [
+                _manifest_entry(
+                    os.path.join(cache_dir, file_name), serializer_for_file(file_name)
+                )
+                for name, file_name in _list_cache_dir(cache_dir).items()
+                if name not in new_names
+            ]
+            entries = existing + entries
+
+        lines = "".join(json.dumps(entry) + "\n" for entry in entries)
+        with open(manifest, "a", encoding="utf-8") as manifest_file:
+            manifest_file.write(lines)
+
+
+def read_cache_manifest(cache_location: str) -> dict[str, dict[str, Any]]:
+    """Read the manifest of a file:// cache location
+
+    Returns a mapping of cache entry name to its file name, format, size
+    (bytes), row count and creation time. Later records for the same name win.
+    """
+    if not cache_location.startswith("file://"):
+        raise NotImplementedError(
+            f"Cache manifests are not implemented for {cache_location}"
+        )
+    manifest = os.path.join(cache_location[len("file://") :], CACHE_MANIFEST)
+
+    entries: dict[str, dict[str, Any]] = {}
+    with open(manifest, encoding="utf-8") as manifest_file:
+        for line in manifest_file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # a writer died half-way through a line
+                logging.debug("Skipping corrupt manifest line: %s", line)
+                continue
+            # entries from before the choice of formats are pandas parquet
+            entry.setdefault("file", entry["name"] + PANDAS_PARQUET.extension)
+            entries[entry["name"]] = entry
+    return entries
+
+
+def compact_cache_manifest(cache_location: str) -> int:
+    """Rewrite the manifest of a file:// cache location with one record per
+    entry whose file still exists
+
+    Use it after deleting cached files by hand. Returns the number of entries
+    that were dropped.
+    """
+    if not cache_location.startswith("file://"):
+        raise NotImplementedError(
+            f"Cache manifests are not implemented for {cache_location}"
+        )
+    cache_dir = cache_location[len("file://") :]
+    manifest = os.path.join(cache_dir, CACHE_MANIFEST)
+    with _manifest_lock(cache_dir):
+        entries = read_cache_manifest(cache_location)
+        kept = [
+            entry
+            for entry in entries.values()
+            if os.path.exists(os.path.join(cache_dir, entry["file"]))
+        ]
+        tmp_name = f"{manifest}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_name, "w", encoding="utf-8") as manifest_file:
+            manifest_file.write("".join(json.dumps(entry) + "\n" for entry in kept))
+        os.replace(tmp_name, manifest)
+    return len(entries) - len(kept)
+
+
+def get_cache_entries(
+    cache_location: str, dirac_settings: _dirac.DiracSettings | None = None
+) -> dict[str, str]:
+    """Map the names of cached entries to their file names
+
+    For file:// locations the manifest is read if there is one, otherwise the
+    directory is listed. dirac:// locations are listed with ``dirac_settings``,
+    or with settings taken from the environment.
+    """
+
+    if cache_location.startswith("file://"):
+        try:
+            manifest = read_cache_manifest(cache_location)
+        except FileNotFoundError:
+            cache_dir = cache_location[len("file://") :]
+            return _list_cache_dir(cache_dir) if os.path.isdir(cache_dir) else {}
+        return {name: entry["file"] for name, entry in manifest.items()}
+    if cache_location.startswith("dirac://"):
+        lfn_dir = cache_location[len("dirac://") :].rstrip("/")
+        settings = dirac_settings or _dirac.settings_from_environment()
+        # entries written before sharding are directly in the cache directory
+        shards = [f"{lfn_dir}/{shard:02x}" for shard in range(DIRAC_CACHE_SHARDS)]
+        result = _dirac.get_directory_dump(settings, [lfn_dir, *shards])
+        entries = {}
+        for lfn in _dirac.get_directory_success_files(result):
+            file_name = lfn[len(lfn_dir) + 1 :] if lfn.startswith(lfn_dir) else lfn
+            base_name = os.path.basename(file_name)
+            if is_cache_file(base_name):
+                entries[split_cache_file_name(base_name)[0]] = file_name
+        return entries
+
+    # TODO: RUCIO
+    raise NotImplementedError(f"Caching is not implemented yet for {cache_location}")
+
+
+def get_cached_files(
+    cache_location: str, dirac_settings: _dirac.DiracSettings | None = None
+) -> list[str]:
+    """Get cached filed from cache location"""
+    return list(get_cache_entries(cache_location, dirac_settings))
@@ -3,44 +3,476 @@
 # from dask.distributed import
 from __future__ import annotations
 
-import getpass
-import glob
-import hashlib
+import ast
+import asyncio
+import copy
+import functools
 import logging
-import os
-from collections.abc import Callable
+import math
+import shlex
+import time
+import uuid
+import warnings
+import weakref
+from collections.abc import Awaitable, Callable, Collection, Mapping, Sequence
 from typing import Any
 
-import dask.core
-import pandas as pd
-from dask.distributed import Client
-from dask.highlevelgraph import HighLevelGraph
+import dask.config
+from dask.utils import parse_timedelta, tmpfile
 from dask_jobqueue.core import Job, JobQueueCluster, cluster_parameters, job_parameters
-from distributed.deploy.spec import ProcessInterface
+from distributed.compatibility import PeriodicCallback
+from distributed.comm.addressing import get_address_host_port, parse_address
+from distributed.security import Security
 from requests import get
 
 from . import _dirac
+from ._dirac_async import AsyncDiracClient
+from ._pilot import upload_text, write_rendezvous
+from ._tls import temporary_security
 from .templates import get_template
 
 logger = logging.getLogger(__name__)
 
+# DIRAC's default limit, used if the server can not be asked for its own
+DEFAULT_MAX_PARAMETRIC_JOBS = 20
+PUBLIC_ADDRESS_URL = "https://v4.ident.me/"
+# unpacked docker images, as published by the CVMFS DUCC service
+UNPACKED_IMAGES_DIR = "/cvmfs/unpacked.cern.ch"
+# permissions of the worker TLS files on grid storage
+CREDENTIALS_MODE = 0o600
 
-def _get_site_ports(sites: list[str] | str) -> str:
+
+def _get_site_ports(sites: Sequence[str] | str) -> str:
     if "LCG.UKI-SOUTHGRID-RALPP.uk" in sites:
         return " --worker-port 50000:52000"
 
     return " "  # None
 
 
-def _create_tmp_jdl_path() -> str:
-    return (
-        "/tmp/dask-dirac-JDL_"
-        + hashlib.sha1(getpass.getuser().encode("utf-8")).hexdigest()[:8]
+def _shares_scheduler_key(security: Security) -> bool:
+    """Whether the workers of ``security`` use the key of the scheduler"""
+    worker_key = security.get_tls_config_for_role("worker")["key"]
+    scheduler_key = security.get_tls_config_for_role("scheduler")["key"]
+    return bool(worker_key) and worker_key == scheduler_key
+
+
+def _unpacked_image(container: str) -> str | None:
+    """Where the docker image ``container`` is unpacked on CVMFS, if it is"""
+    if not container.startswith("docker://"):
+        return None
+    image = container.removeprefix("docker://")
+    registry, _, path = image.partition("/")
+    if not path or not ("." in registry or ":" in registry):
+        # an image on Docker Hub
+        registry, path = "registry.hub.docker.com", image
+        if "/" not in path:
+            path = f"library/{path}"
+    return f"{UNPACKED_IMAGES_DIR}/{registry}/{path}"
+
+
+@functools.lru_cache(maxsize=128)
+def _render_jdl(
+    public_address: str,
+    parameters: int | None,
+    jdl_kwargs: tuple[tuple[str, Any], ...],
+) -> str:
+    """Render the JDL of a job, reusing earlier renderings of identical jobs"""
+    return get_template("jdl.j2").render(
+        public_address=public_address, parameters=parameters, **dict(jdl_kwargs)
     )
 
 
+class PublicAddressCache:
+    """Public IP address of this machine, as seen from the internet
+
+    The address is looked up at most once every ``ttl`` seconds, in a
+    thread, and concurrent callers on an event loop share the same lookup.
+    """
+
+    def __init__(self, url: str = PUBLIC_ADDRESS_URL, ttl: float = 3600) -> None:
+        self.url = url
+        self.ttl = ttl
+        self._address: str | None = None
+        self._looked_up_at = 0.0
+        self._lookups: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, asyncio.Future[str]
+        ] = weakref.WeakKeyDictionary()
+
+    async def get(self) -> str:
+        """The cached address, looking it up if it is missing or too old"""
+        if (
+            self._address is not None
+            and time.monotonic() < self._looked_up_at + self.ttl
+        ):
+            return self._address
+        loop = asyncio.get_running_loop()
+        lookup = self._lookups.get(loop)
+        if lookup is None:
+            lookup = self._lookups[loop] = asyncio.ensure_future(self._lookup(loop))
+        return await asyncio.shield(lookup)
+
+    async def _lookup(self, loop: asyncio.AbstractEventLoop) -> str:
+        try:
+            response = await loop.run_in_executor(
+                None, functools.partial(get, self.url, timeout=30)
+            )
+            address: str = response.content.decode("utf8").strip()
+        finally:
+            del self._lookups[loop]
+        logger.debug("Public address is %s", address)
+        self._address, self._looked_up_at = address, time.monotonic()
+        return address
+
+
+_public_address = PublicAddressCache()
+
+
+class ParametricBatcher:
+    """Combine concurrent submissions of identical jobs into parametric jobs
+
+    Every call of ``job_id`` waits ``delay`` seconds for others to arrive, and
+    all waiting calls are then served with ``submit(n)`` calls for batches of
+    at most ``max_batch_size`` jobs. ``submit`` returns the ids of the ``n``
+    jobs it submitted. If ``max_batch_size`` is not given, it is taken from
+    ``get_max_batch_size`` when the first batch is submitted.
+
+    ``job_id`` can be passed the ``submit`` and ``get_max_batch_size`` of the
+    job instead, and a batch is then submitted with those of its first job.
+    The batcher only holds on to them while the job is waiting.
+    """
+
+    def __init__(
+        self,
+        submit: Callable[[int], Awaitable[list[str]]] | None = None,
+        max_batch_size: int | None = None,
+        get_max_batch_size: Callable[[], Awaitable[int]] | None = None,
+        delay: float = 0.1,
+    ) -> None:
+        self._submit = submit
+        self.max_batch_size = max_batch_size
+        self._get_max_batch_size = get_max_batch_size
+        self.delay = delay
+        # each job's future, submit and get_max_batch_size
+        self._pending: list[
+            tuple[
+                asyncio.Future[str],
+                Callable[[int], Awaitable[list[str]]],
+                Callable[[], Awaitable[int]] | None,
+            ]
+        ] = []
+        self._flush_task: asyncio.Future[None] | None = None
+
+    async def job_id(
+        self,
+        submit: Callable[[int], Awaitable[list[str]]] | None = None,
+        get_max_batch_size: Callable[[], Awaitable[int]] | None = None,
+    ) -> str:
+        """Submit a job, as part of the next batch, and return its id"""
+        submit = submit or self._submit
+        if submit is None:
+            raise ValueError("ParametricBatcher needs a submit function")
+        future: asyncio.Future[str] = asyncio.get_running_loop().create_future()
+        self._pending.append(
+            (future, submit, get_max_batch_size or self._get_max_batch_size)
+        )
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush())
+        return await future
+
+    async def _flush(self) -> None:
+        await asyncio.sleep(self.delay)
+        if self.max_batch_size is None:
+            self.max_batch_size = DEFAULT_MAX_PARAMETRIC_JOBS
+            get_max_batch_size = self._pending[0][2]
+            if get_max_batch_size is not None:
+                self.max_batch_size = await get_max_batch_size()
+        pending, self._pending = self._pending, []
+        self._flush_task = None
+
+        size = max(self.max_batch_size, 1)
+        batches = [pending[i : i + size] for i in range(0, len(pending), size)]
+        logger.debug(
+            "Submitting %d jobs in %d parametric jobs", len(pending), len(batches)
+        )
+        await asyncio.gather(*(self._submit_batch(batch) for batch in batches))
+
+    async def _submit_batch(
+        self,
+        batch: list[
+            tuple[
+                asyncio.Future[str],
+                Callable[[int], Awaitable[list[str]]],
+                Callable[[], Awaitable[int]] | None,
+            ]
+        ],
+    ) -> None:
+        submit = batch[0][1]
+        try:
+            job_ids = await submit(len(batch))
+            if len(job_ids) != len(batch):
+                raise ValueError(
+                    f"Submitted {len(batch)} jobs, but got {len(job_ids)} job ids"
+                )
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            for future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for (future, _, _), job_id in zip(batch, job_ids):
+            if not future.done():
+                future.set_result(job_id)
+
+
+class CancelBatcher:
+    """Combine concurrent cancellations of jobs into bulk requests
+
+    Every call of ``cancel`` waits ``delay`` seconds for others to arrive, and
+    the ids of all waiting jobs are then passed to ``cancel_jobs`` in batches
+    of at most ``max_batch_size``. Like ``submit`` of a ``ParametricBatcher``,
+    ``cancel_jobs`` can instead be passed to ``cancel`` by each job.
+    """
+
+    def __init__(
+        self,
+        cancel_jobs: Callable[[list[str]], Awaitable[None]] | None = None,
+        max_batch_size: int = 500,
+        delay: float = 0.1,
+    ) -> None:
+        self._cancel_jobs = cancel_jobs
+        self.max_batch_size = max_batch_size
+        self.delay = delay
+        self._pending: list[
+            tuple[str, asyncio.Future[None], Callable[[list[str]], Awaitable[None]]]
+        ] = []
+        self._flush_task: asyncio.Future[None] | None = None
+
+    async def cancel(
+        self,
+        job_id: str,
+        cancel_jobs: Callable[[list[str]], Awaitable[None]] | None = None,
+    ) -> None:
+        """Cancel a job, as part of the next batch"""
+        cancel_jobs = cancel_jobs or self._cancel_jobs
+        if cancel_jobs is None:
+            raise ValueError("CancelBatcher needs a cancel_jobs function")
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._pending.append((job_id, future, cancel_jobs))
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush())
+        await future
+
+    async def _flush(self) -> None:
+        await asyncio.sleep(self.delay)
+        pending, self._pending = self._pending, []
+        self._flush_task = None
+
+        size = max(self.max_batch_size, 1)
+        batches = [pending[i : i + size] for i in range(0, len(pending), size)]
+        logger.debug("Cancelling %d jobs in %d requests", len(pending), len(batches))
+        await asyncio.gather(*(self._cancel_batch(batch) for batch in batches))
+
+    async def _cancel_batch(
+        self,
+        batch: list[
+            tuple[str, asyncio.Future[None], Callable[[list[str]], Awaitable[None]]]
+        ],
+    ) -> None:
+        cancel_jobs = batch[0][2]
+        try:
+            await cancel_jobs([job_id for job_id, _, _ in batch])
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for _, future, _ in batch:
+            if not future.done():
+                future.set_result(None)
+
+
+# batchers of the jobs of each DIRAC client, that is of each cluster, one per
+# distinct job (server, credentials, JDL, submission options)
+_batchers: weakref.WeakKeyDictionary[
+    AsyncDiracClient, dict[tuple[Any, ...], ParametricBatcher]
+] = weakref.WeakKeyDictionary()
+# canceller of the jobs of each DIRAC client
+_cancellers: weakref.WeakKeyDictionary[AsyncDiracClient, CancelBatcher] = (
+    weakref.WeakKeyDictionary()
+)
+# clients of each event loop for jobs outside of a cluster, one per server and
+# credentials
+_clients: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, dict[tuple[Any, ...], AsyncDiracClient]
+] = weakref.WeakKeyDictionary()
+
+
+def _job_ids_from_submit_output(out: str) -> list[str]:
+    """Job ids from the output of ``dask-dirac submit``"""
+    return _job_ids_from_result(ast.literal_eval(out.strip()))
+
+
+def _job_ids_from_result(result: dict[str, Any]) -> list[str]:
+    """Job ids from the reply of the server to ``submitJob``"""
+    if not result.get("OK", False):
+        raise RuntimeError(f"Job submission failed: {result.get('Message', result)}")
+    value = result["Value"]
+    if isinstance(value, list):
+        return [str(job_id) for job_id in value]
+    return [str(value)]
+
+
+# DIRAC job states in which a job has started running
+STARTED_JOB_STATES = frozenset({"Running", "Completing", "Done", "Completed"})
+
+
+class SiteStatistics:
+    """How long jobs queue at each site before they start running
+
+    Jobs are recorded with ``submitted`` and ``observe`` is fed their DIRAC
+    status, after which the queue latency of the jobs that started is known.
+    The latency of a site is estimated from the jobs that started there and
+    the time jobs that are still waiting have been queued so far, so a site
+    that does not start jobs gets slower the longer they wait.
+    """
+
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = {}
+        self._waiting: dict[str, tuple[str, float]] = {}
+        # number of allocations so far, rotates the order in which ties go
+        self._allocations = 0
+
+    def submitted(self, job_id: str, site: str) -> None:
+        """Record that ``job_id`` was submitted to ``site`` just now"""
+        self._waiting[job_id] = (site, time.monotonic())
+
+    def forget(self, job_id: str) -> None:
+        """Stop waiting for ``job_id``, e.g. because it was cancelled"""
+        self._waiting.pop(job_id, None)
+
+    def observe(self, statuses: Mapping[str, str]) -> None:
+        """Update the waiting jobs from their DIRAC status"""
+        now = time.monotonic()
+        for job_id, status in statuses.items():
+            if job_id not in self._waiting:
+                continue
+            if status in STARTED_JOB_STATES:
+                site, submitted_at = self._waiting.pop(job_id)
+                self.latencies.setdefault(site, []).append(now - submitted_at)
+                logger.debug("Job %s started at %s", job_id, site)
+            elif status in ENDED_JOB_STATES:
+                del self._waiting[job_id]
+
+    def timed_out(self, job_id: str) -> None:
+        """Record that ``job_id`` is given up on after queueing for too long
+
+        The time it has waited so far counts against its site, as if the job
+        had started just now.
+        """
+        if job_id not in self._waiting:
+            return
+        site, submitted_at = self._waiting.pop(job_id)
+        self.latencies.setdefault(site, []).append(time.monotonic() - submitted_at)
+        logger.debug("Job %s timed out at %s", job_id, site)
+
+    def latency(self, site: str) -> float | None:
+        """Mean queue latency of ``site`` in seconds, None if nothing is known"""
+        now = time.monotonic()
+        samples = list(self.latencies.get(site, []))
+        samples += [
+            now - submitted_at
+            for waiting_site, submitted_at in self._waiting.values()
+            if waiting_site == site
+        ]
+        return sum(samples) / len(samples) if samples else None
+
+    def allocate(self, n_jobs: int, sites: Collection[str]) -> dict[str, int]:
+        """Split ``n_jobs`` between ``sites``, in proportion to 1 / latency
+
+        Sites that have not been tried yet count as fast as the fastest known
+        site, so that they get tried. Jobs left over after the proportional
+        split go to a different site each time when sites are tied.
+        """
+        sites = list(sites)
+        if sites:
+            start = self._allocations % len(sites)
+            sites = sites[start:] + sites[:start]
+        self._allocations += 1
+        latencies = {site: self.latency(site) for site in sites}
+        known = [latency for latency in latencies.values() if latency is not None]
+        default = min(known) if known else 1.0
+        weights = {
+            site: 1 / max(default if latency is None else latency, 1e-3)
+            for site, latency in latencies.items()
+        }
+        total = sum(weights.values())
+        shares = {site: n_jobs * weight / total for site, weight in weights.items()}
+        allocation = {site: int(share) for site, share in shares.items()}
+        # hand out what is left by largest remainder, ties in rotated order
+        remainders = sorted(
+            shares, key=lambda site: shares[site] - allocation[site], reverse=True
+        )
+        for site in remainders[: n_jobs - sum(allocation.values())]:
+            allocation[site] += 1
+        return {site: count for site, count in allocation.items() if count}
+
+
 class DiracJob(Job):
-    """Job class for Dirac"""
+    """Job class for Dirac
+
+    Unless ``batch_submissions=False``, jobs that are started together (as
+    by ``cluster.scale``) are submitted as parametric jobs of up to
+    ``max_parametric_jobs`` jobs each, by default the maximum the server
+    allows.
+
+    Jobs are submitted from the event loop of the cluster, with the query
+    running in a thread. With ``in_process_submission=False`` they are
+    submitted with the ``dask-dirac submit`` command instead.
+
+    When the cluster scales down or closes, the jobs of the workers that are
+    closed are killed and deleted, with one request for all jobs closed at
+    the same time.
+
+    Jobs with more than one core (``cores``) or worker process
+    (``processes``) ask DIRAC for ``cores`` processors and ``memory`` and
+    start ``processes`` workers with ``dask worker --nworkers``, splitting the
+    cores and memory between them. Without ``memory``, DIRAC's default is
+    asked for and the workers are not given a memory limit of their own.
+    ``whole_node=True`` asks for a whole node and lets ``dask worker`` choose
+    the number of workers and threads from the cores it finds there.
+
+    If ``site_statistics`` are given and there is more than one site in
+    ``dirac_sites``, each submission is split between the sites, giving more
+    jobs to sites that have started jobs faster. Each part is submitted to a
+    single site, so DIRAC can no longer run it at whichever site is free first.
+
+    ``jdl_file`` is deprecated and ignored: the JDL is rendered in memory.
+
+    Workers connect to the scheduler at ``scheduler_address`` (a host name or
+    IP address), or the ``dirac.scheduler-address`` config value. By default
+    the public address of this machine is looked up when jobs are submitted.
+
+    With ``rendezvous`` (the LFN of a file in the DIRAC FileCatalog), the job
+    is a long-lived pilot: it runs ``dask-dirac pilot``, which starts workers
+    for whichever scheduler is published in the file, one after the other,
+    and exits after ``pilot_idle_timeout`` seconds without a new scheduler.
+    The container has to provide dask-dirac and gfal2 for this.
+
+    With ``security``, workers listen and connect with TLS (``protocol``
+    defaults to ``tls://``). The worker certificate, key and CA files are
+    looked for in the working directory of the job, where the job gets them
+    from the LFNs in ``input_sandbox``.
+
+    DIRAC queries go through ``dirac_client``, which the jobs of a
+    ``DiracCluster`` share. Jobs without one share a client with the other
+    jobs of the event loop that use the same server and credentials.
+
+    Jobs run their command in the first of ``container_images`` (unpacked
+    images or SIF files; environment variables such as a site's software area
+    are expanded on the worker node) that exists on the node, and only pull
+    ``container`` if none does. By default ``container_images`` is where the
+    docker image ``container`` would be unpacked on
+    ``/cvmfs/unpacked.cern.ch``.
+    """
 
     config_name = "htcondor"  # avoid writing new one for now
 
@@ -52,47 +484,307 @@ class DiracJob(Job):
         submission_url: str = "https://diracdev.grid.hep.ph.ic.ac.uk:8444",
         user_proxy: str = "/tmp/x509up_u1000",
         cert_path: str = "/etc/grid-security/certificates",
-        jdl_file: str = _create_tmp_jdl_path(),
+        jdl_file: str | None = None,
         owner_group: str = "dteam_user",
         dirac_sites: list[str] | str | None = None,
         require_gpu: bool = False,
         container: str = "docker://sameriksen/dask:centos9",
         nthreads: int | None = None,
+        batch_submissions: bool = True,
+        max_parametric_jobs: int | None = None,
+        in_process_submission: bool = True,
+        scheduler_address: str | None = None,
+        site_statistics: SiteStatistics | None = None,
+        whole_node: bool = False,
+        rendezvous: str | None = None,
+        pilot_idle_timeout: float = 1800,
+        protocol: str | None = None,
+        security: Security | None = None,
+        input_sandbox: Collection[str] | None = None,
+        container_images: Sequence[str] | None = None,
+        dirac_client: AsyncDiracClient | None = None,
         **base_class_kwargs: dict[str, Any],
     ) -> None:
+        if jdl_file is not None:
+            warnings.warn(
+                "jdl_file is deprecated and ignored, the JDL is rendered in memory",
+                DeprecationWarning,
+                stacklevel=2,
+            )
+        memory = base_class_kwargs.pop("memory", None) or dask.config.get(
+            f"jobqueue.{config_name or self.config_name}.memory", None
+        )
         super().__init__(
-            scheduler=scheduler, name=name, config_name=config_name, **base_class_kwargs
+            scheduler=scheduler,
+            name=name,
+            config_name=config_name,
+            protocol=protocol,
+            security=security,
+            # only used for the workers of multicore jobs, 0 means no limit
+            memory=memory or 0,
+            **base_class_kwargs,
+        )
+        self.scheduler_address = scheduler_address or dask.config.get(
+            "dirac.scheduler-address", None
         )
-        # public_address = get("https://ifconfig.me", timeout=30).content.decode("utf8")
-        public_address = get("https://v4.ident.me/", timeout=30).content.decode("utf8")
-        jdl_template = get_template("jdl.j2")
 
-        extra_args = _get_site_ports(dirac_sites) if dirac_sites else ""
+        multicore = self.worker_cores > 1 or self.worker_processes > 1 or whole_node
+        # the ports of a site are added per submission, see _submit_jdl
+        extra_args = ""
+        if whole_node:
+            # the number of cores of the node is not known until it runs
+            extra_args += " --nworkers auto"
+        elif multicore:
+            extra_args += f" --nworkers {self.worker_processes}"
+            nthreads = nthreads or self.worker_process_threads
+            if self.worker_memory:
+                extra_args += f" --memory-limit {self.worker_process_memory}"
         extra_args += f" --nthreads {nthreads}" if nthreads else ""
+        if security:
+            protocol = protocol or "tls://"
+            extra_args += f" --protocol {protocol}"
+            worker_tls = security.get_tls_config_for_role("worker")
+            for key in ("ca_file", "cert", "key"):
+                if worker_tls[key]:
+                    extra_args += f" --tls-{key.replace('_', '-')} {worker_tls[key]}"
 
         if isinstance(dirac_sites, str):
             dirac_sites = [dirac_sites]
+        self.dirac_sites = tuple(dirac_sites) if dirac_sites is not None else None
+
+        if container_images is None:
+            unpacked_image = _unpacked_image(container)
+            container_images = [unpacked_image] if unpacked_image else []
+
+        self._jdl_kwargs = {
+            "container": container,
+            "container_images": tuple(container_images),
+            "owner": owner_group,
+            "dirac_sites": self.dirac_sites,
+            "require_gpu": require_gpu,
+            "extra_args": extra_args,
+            "number_of_processors": (
+                self.worker_cores if multicore and not whole_node else None
+            ),
+            "max_ram": (
+                self.worker_memory // 2**20
+                if multicore and self.worker_memory
+                else None
+            ),
+            "whole_node": whole_node,
+            "rendezvous": rendezvous,
+            "server_url": submission_url,
+            "idle_timeout": pilot_idle_timeout,
+            "protocol": protocol or "tcp://",
+            "input_sandbox": tuple(input_sandbox) if input_sandbox else None,
+        }
+
+        self._submission_kwargs = {
+            "submission_url": submission_url,
+            "cert_path": cert_path,
+            "user_proxy": user_proxy,
+        }
+        self.batch_submissions = batch_submissions
+        self.max_parametric_jobs = max_parametric_jobs
+        self.in_process_submission = in_process_submission
+        self.site_statistics = site_statistics
+        self.rendezvous = rendezvous
+        self._dirac_client = dirac_client
+
+    async def start(self) -> None:
+        """Submit the job, batched with other jobs that start at the same time"""
+        logger.debug("Starting worker: %s", self.name)
+        if self.batch_submissions:
+            self.job_id = await self._batcher().job_id(
+                self._submit_parametric, self._get_max_parametric_jobs
+            )
+        else:
+            (self.job_id,) = await self._submit_parametric(1)
+        logger.debug("Starting job: %s", self.job_id)
+        # skip Job.start, which submits the job on its own
+        await super(Job, self).start()  # pylint: disable=bad-super-call
+
+    async def close(self) -> None:
+        """Kill and delete the job, together with others closed at the same time"""
+        logger.debug("Stopping worker: %s job: %s", self.name, self.job_id)
+        if self.job_id and self.site_statistics is not None:
+            # a job closed before it started says nothing about its site
+            self.site_statistics.forget(self.job_id)
+        if self.job_id:
+            try:
+                await self._canceller().cancel(self.job_id, self._cancel_jobs)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.warning("Could not cancel job %s", self.job_id, exc_info=True)
+            else:
+                logger.debug("Closed job %s", self.job_id)
+        # skip Job.close, which runs cancel_command
+        await super(Job, self).close()  # pylint: disable=bad-super-call
+
+    def _canceller(self) -> CancelBatcher:
+        # jobs pass their own cancel function, the canceller keeps no job alive
+        return _cancellers.setdefault(self._client(), CancelBatcher())
+
+    async def _cancel_jobs(self, job_ids: list[str]) -> None:
+        """Kill ``job_ids`` and then delete them"""
+        client = self._client()
+        for cancel in (client.kill_jobs, client.delete_jobs):
+            result = await cancel(job_ids)
+            if not result.get("OK", False):
+                # jobs that have already finished can not be killed
+                logger.info(
+                    "Could not %s all jobs: %s",
+                    cancel.__name__.split("_")[0],
+                    result.get("Message", result),
+                )
 
-        rendered_jdl = jdl_template.render(
-            container=container,
-            public_address=public_address,
-            owner=owner_group,
-            dirac_sites=dirac_sites,
-            require_gpu=require_gpu,
-            extra_args=extra_args,
+    def _batcher(self) -> ParametricBatcher:
+        # jobs of other clusters have other clients, and so other batchers
+        batchers = _batchers.setdefault(self._client(), {})
+        key = (
+            *self._submission_kwargs.values(),
+            self.scheduler_address,
+            *self._jdl_kwargs.items(),
+            self.in_process_submission,
+            self.max_parametric_jobs,
+            self.site_statistics,
+        )
+        if key not in batchers:
+            batchers[key] = ParametricBatcher(max_batch_size=self.max_parametric_jobs)
+        return batchers[key]
+
+    async def _submit_parametric(self, n_jobs: int) -> list[str]:
+        """Submit ``n_jobs`` copies of this job and return their ids"""
+        sites = self.dirac_sites
+        if self.site_statistics is None or not sites or len(sites) < 2:
+            return await self._submit_jdl(n_jobs, sites)
+
+        statistics = self.site_statistics
+        allocation = statistics.allocate(n_jobs, sites)
+        logger.debug("Submitting jobs to sites: %s", allocation)
+
+        async def submit_to_site(site: str, count: int) -> list[str]:
+            job_ids = await self._submit_jdl(count, (site,))
+            for job_id in job_ids:
+                statistics.submitted(job_id, site)
+            return job_ids
+
+        results = await asyncio.gather(
+            *(submit_to_site(site, count) for site, count in allocation.items()),
+            return_exceptions=True,
+        )
+        job_ids = [
+            job_id
+            for result in results
+            if not isinstance(result, BaseException)
+            for job_id in result
+        ]
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            # the whole batch fails, so nobody would cancel the jobs that went in
+            if job_ids:
+                logger.warning("Cancelling jobs %s of a failed submission", job_ids)
+                for job_id in job_ids:
+                    statistics.forget(job_id)
+                await self._cancel_jobs(job_ids)
+            raise errors[0]
+        return job_ids
+
+    async def _submit_jdl(
+        self, n_jobs: int, sites: tuple[str, ...] | None
+    ) -> list[str]:
+        """Submit ``n_jobs`` copies of this job to ``sites``"""
+        extra_args = (_get_site_ports(sites) if sites else "") + str(
+            self._jdl_kwargs["extra_args"]
+        )
+        jdl = _render_jdl(
+            # pilots find the scheduler through the rendezvous file
+            "" if self.rendezvous else await self.public_address(),
+            n_jobs if n_jobs > 1 else None,
+            tuple(
+                dict(self._jdl_kwargs, dirac_sites=sites, extra_args=extra_args).items()
+            ),
+        )
+        if self.in_process_submission:
+            return _job_ids_from_result(await self._client().submit_job(jdl))
+
+        # the command reads the JDL from a file of its own
+        with tmpfile(extension="jdl") as jdl_file:
+            with open(jdl_file, mode="w", encoding="utf-8") as jdl_handle:
+                jdl_handle.write(jdl)
+            submit_command = get_template("submit_command.j2").render(
+                jdl_file=jdl_file, **self._submission_kwargs
+            )
+            out = await self._call(shlex.split(submit_command) + [jdl_file])
+        return _job_ids_from_submit_output(out)
+
+    async def public_address(self) -> str:
+        """Address at which workers reach the scheduler"""
+        return self.scheduler_address or await _public_address.get()
+
+    def _dirac_settings(self) -> _dirac.DiracSettings:
+        return _dirac.DiracSettings(
+            self._submission_kwargs["submission_url"],
+            self._submission_kwargs["cert_path"],
+            self._submission_kwargs["user_proxy"],
         )
 
-        # Write JDL
-        with open(jdl_file, mode="w", encoding="utf-8") as jdl:
-            jdl.write(rendered_jdl)
+    def _client(self) -> AsyncDiracClient:
+        """Client for the DIRAC queries of this job"""
+        if self._dirac_client is None:
+            clients = _clients.setdefault(asyncio.get_running_loop(), {})
+            key = tuple(self._submission_kwargs.values())
+            if key not in clients:
+                clients[key] = AsyncDiracClient(self._dirac_settings())
+            self._dirac_client = clients[key]
+        return self._dirac_client
+
+    async def _get_max_parametric_jobs(self) -> int:
+        try:
+            result = await self._client().get_max_parametric_jobs()
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            result = {"OK": False, "Message": str(exc)}
+        if not result.get("OK", False):
+            logger.warning(
+                "Could not get the maximum number of parametric jobs: %s, using %d",
+                result.get("Message", result),
+                DEFAULT_MAX_PARAMETRIC_JOBS,
+            )
+            return DEFAULT_MAX_PARAMETRIC_JOBS
+        return int(result["Value"])
+
+
+# DIRAC job states after which a job will not run a worker (again)
+ENDED_JOB_STATES = frozenset(
+    {"Done", "Completed", "Failed", "Killed", "Deleted", "Stalled"}
+)
+
+
+class JobStatusMonitor:
+    """Cache of the DIRAC status of a set of jobs
+
+    ``update`` asks for the status of all jobs in a single ``getJobsStatus``
+    query; ``statuses`` holds the result of the last update.
+    """
 
-        cmd_template = get_template("submit_command.j2")
-        self.submit_command = cmd_template.render(
-            submission_url=submission_url,
-            jdl_file=jdl_file,
-            cert_path=cert_path,
-            user_proxy=user_proxy,
-        ).strip()
+    def __init__(self, client: AsyncDiracClient) -> None:
+        self._client = client
+        self.statuses: dict[str, str] = {}
+        self.updated_at: float | None = None
+
+    async def update(self, job_ids: Collection[str]) -> dict[str, str]:
+        """Fetch the status of ``job_ids``, forgetting about other jobs"""
+        if not job_ids:
+            self.statuses = {}
+            return self.statuses
+        result = await self._client.get_jobs_status(list(job_ids))
+        if not result.get("OK", False):
+            logger.warning("Could not get job status: %s", result.get("Message"))
+            return self.statuses
+        self.statuses = {
+            str(job_id): info["Status"] for job_id, info in result["Value"].items()
+        }
+        self.updated_at = time.monotonic()
+        return self.statuses
 
 
 class DiracCluster(JobQueueCluster):  # pylint: disable=missing-class-docstring
@@ -102,6 +794,45 @@ class DiracCluster(JobQueueCluster):  # pylint: disable=missing-class-docstring
     ----------
     server_url: str
         URL to the DIRAC instance
+    status_interval: str or float
+        How often the status of all jobs is fetched from DIRAC, in one query.
+        Jobs that have ended (or stalled) without being closed are replaced.
+    queue_timeout: str or float
+        Cancel and replace jobs that have not started running this long after
+        their status was first fetched, e.g. because they are stuck in the
+        queue of a busy site. With ``prefer_fast_sites`` the time counts
+        against their site. Off by default.
+    prefer_fast_sites: bool
+        Record how long jobs queue at each of the ``dirac_sites`` and send
+        more of the new jobs to the sites that start them faster. Off by
+        default: it submits every job to a single site, giving up DIRAC's
+        late binding of jobs to whichever site has a free slot first.
+    overprovision_factor: float
+        Submit this many times the additional jobs asked for by ``scale``.
+        Once the requested number of workers has connected, the surplus jobs
+        that have not started are cancelled. The time it took is in ``time_to_target``.
+    rendezvous: str
+        LFN of a file in the DIRAC FileCatalog. The jobs are long-lived
+        pilots that connect to the scheduler published in this file, and the
+        cluster publishes its scheduler there when it starts. Closing the
+        cluster leaves the pilots running, so that the next cluster with the
+        same ``rendezvous`` (see ``from_name``) gets their workers at once.
+    credentials_dir: str
+        LFN directory for the worker TLS files, with ``security``. The
+        certificate, key and CA file of the workers are uploaded to a
+        subdirectory of it when the cluster starts, made readable by their
+        owner only, handed to the jobs in their InputSandbox, and deleted from
+        the storage element and the FileCatalog when the cluster closes. With
+        ``security=True``, a temporary CA made for this cluster signs separate
+        certificates for the scheduler and the workers, and only the worker
+        key leaves this machine; a ``Security`` whose workers use the key of
+        the scheduler is refused.
+    allow_unrestricted_credentials: bool
+        Start even if the storage element can not make the replicas of the
+        worker TLS files readable by their owner only, in which case anybody
+        who can read ``credentials_dir`` on the storage element can connect to
+        the cluster as a worker. Off by default: the cluster does not start,
+        and the files that were uploaded are deleted.
     {job_parameters}
     {cluster_parameters}
 
@@ -117,286 +848,300 @@ class DiracCluster(JobQueueCluster):  # pylint: disable=missing-class-docstring
     job_cls = DiracJob
 
     def __init__(self, *args, **kwargs) -> None:  # type: ignore[no-untyped-def]
-        """Set defaults to be able to use htcondor config. Not actually used with Dirac"""
+        """Set defaults to be able to use htcondor config. ``memory`` is only
+        used by multicore jobs, see DiracJob"""
         kwargs.setdefault("cores", 1)
-        kwargs.setdefault("memory", "0.5GB")
-        super().__init__(*args, **kwargs)
-
-    @classmethod
-    def from_name(cls, name: str) -> ProcessInterface:
-        """Create a cluster from a name"""
-        return super().from_name(name)
-
-
-class DiracClient(Client):
-    """Client for caching dask computations"""
-
-    def __init__(self, *args, cache_location: str = "file:///tmp/dask-dirac-cache", **kwargs) -> None:  # type: ignore[no-untyped-def]
-        super().__init__(*args, **kwargs)
-        self.cache_location = cache_location
-
-    def _graph_to_futures(
-        self,
-        dsk: dict[str, Any] | HighLevelGraph,
-        *args: dict[str, Any],
-        **kwargs: dict[str, Any],
-    ) -> Any:
-        if not isinstance(dsk, HighLevelGraph):
-            dsk = HighLevelGraph.from_collections(id(dsk), dsk, dependencies={})
-
-        info = dsk.to_dict()
-        logging.debug(
-            "Input dask graph:\n%s\n---------\nperforming caching checks\n---------",
-            info,
-        )
-
-        sorted_keys = dask.core.toposort(info)
-        tmp_info: dict[str, Any] = {}
-        for key in sorted_keys:
-            value = info[key]
-            hash_tuple = None
-            hash_base = None
-            value_for_hash = value
-            check_layer = True
-            logging.debug("Key: %s, Value: %s", key, value)
-            logging.debug("Checking if tmp_keys: %s, are in %s", tmp_info.keys(), value)
-            for t_key, t_value in tmp_info.items():
-                try:
-                    if t_key in value:
-                        logging.debug("Found %s in %s", t_key, value)
-                        index = value.index(t_key)
-
-                        hash_base = t_value["hash"]  # [index]
-                        temp_list = list(value_for_hash)
-                        temp_list[index] = hash_base
-                        value_for_hash = tuple(temp_list)
-                        logging.debug(hash_base)
-                        logging.debug(value_for_hash)
-                        logging.debug(index)
-                    elif t_key == value:
-                        logging.debug("Found %s in %s", t_key, value)
-                        hash_base = t_value["hash"][0]
-                        check_layer = False
-                        hash_tuple = hash_base
-                except KeyError:  # ignore problem for now
-                    continue
-
-            if hash_tuple is None:
-                # Now we have the hash_base,
-                _, hash_tuple = generate_hash_from_value(value_for_hash)
-
-            tmp_info[key] = {
-                "value": value,
-                "hash": hash_tuple,
-                "check_layer": check_layer,
-            }
-
-        logging.debug("---------\nHashes: %s\n---------", tmp_info)
-
-        # Now check layers that need to be checked, adding caching
-        tmp_2 = {}
-        for key, value in tmp_info.items():
-            logging.debug("Checking %s... ", key)
-            # Now we check if hash exist at some location
-            input_func_tuple = value["value"]
-            input_hash_tuple = value["hash"]
-            if not value["check_layer"]:
-                logging.debug("Not processing layer")
-                tmp_2[key] = input_func_tuple
-            else:
-                func_tuple = check_functions_and_hashes(
-                    input_func_tuple, input_hash_tuple, self.cache_location
-                )
-                tmp_2[key] = func_tuple
-
-            logging.debug("final_function_tuple:\n%s", func_tuple)
-
-        logging.debug("---------\nFinalized graph: %s\n---------", tmp_2)
-
-        dsk = HighLevelGraph.from_collections(id(tmp_2), tmp_2, dependencies={})
-
-        logging.debug(
-            "---------\nFinalized High Level Graph: %s\n---------", dsk.to_dict()
+        self.status_interval = parse_timedelta(kwargs.pop("status_interval", "60s"))
+        self.queue_timeout = parse_timedelta(kwargs.pop("queue_timeout", None))
+        # when the status of each queued job was first fetched
+        self._queued_since: dict[str, float] = {}
+        # shared by the cluster and its jobs, created when the cluster starts
+        self._dirac_client: AsyncDiracClient | None = None
+        self._job_monitor: JobStatusMonitor | None = None
+        self.site_statistics = SiteStatistics()
+        if kwargs.pop("prefer_fast_sites", False):
+            kwargs.setdefault("site_statistics", self.site_statistics)
+        self.overprovision_factor = float(kwargs.pop("overprovision_factor", 1))
+        # number of jobs and of workers asked for, and when
+        self._scale_target: tuple[int, int, float] | None = None
+        self.time_to_target: float | None = None
+        # also passed on to the jobs, which run as pilots
+        self.rendezvous: str | None = kwargs.get("rendezvous")
+        self.credentials_dir: str | None = kwargs.pop("credentials_dir", None)
+        self.allow_unrestricted_credentials = bool(
+            kwargs.pop("allow_unrestricted_credentials", False)
         )
-
-        return super()._graph_to_futures(dsk, *args, **kwargs)
-
-
-def check_functions_and_hashes(
-    func_tuple: Any, hash_tuple: Any, cache_location: str
-) -> Any:
-    """Check if functions and hashes exist in cache"""
-    logging.debug("Checking func_tuple: %s", func_tuple)
-    logging.debug("Checking hash_tuple: %s", hash_tuple)
-
-    cached_files = get_cached_files(cache_location)
-    logging.debug("Cached files: %s", cached_files)
-
-    if len(func_tuple) > 2:
-        logging.debug(
-            "Need to think about how to do this, but for now just check first hash"
+        if kwargs.get("security") and not self.credentials_dir:
+            raise ValueError("security needs a credentials_dir to ship files from")
+        if kwargs.get("security") is True:
+            # unlike Security.temporary, keeps the CA and scheduler keys here
+            kwargs["security"] = temporary_security()
+        if kwargs.get("security") and _shares_scheduler_key(kwargs["security"]):
+            raise ValueError(
+                "the workers use the key of the scheduler, which must not be "
+                "shipped to grid storage; use security=True or worker credentials "
+                "of their own"
+            )
+        # contents of the worker TLS files, by the name the jobs see them under
+        self._worker_credentials: dict[str, str] = {}
+        super().__init__(*args, **kwargs)
+        if self._worker_credentials:
+            self._job_kwargs["input_sandbox"] = tuple(self.worker_credentials.values())
+
+    def _get_worker_security(self, security):  # type: ignore[no-untyped-def]
+        """Security of the workers, with TLS files in the job working directory"""
+        if not security:
+            return None
+        worker_tls = security.get_tls_config_for_role("worker")
+        security = copy.copy(security)
+        for key in ("ca_file", "cert", "key"):
+            value = worker_tls[key]
+            if not value:
+                continue
+            if "\n" not in value:
+                with open(value, encoding="utf-8") as file_handle:
+                    value = file_handle.read()
+            file_name = f"dask-{key.replace('_file', '')}.pem"
+            self._worker_credentials[file_name] = value
+            role = "" if key == "ca_file" else "worker_"
+            setattr(security, f"tls_{role}{key}", file_name)
+        # several clusters can share credentials_dir
+        self.credentials_dir = f"{self.credentials_dir}/{uuid.uuid4().hex[:8]}"
+        return security
+
+    @property
+    def worker_credentials(self) -> dict[str, str]:
+        """LFN of each TLS file of the workers, by its name in the job"""
+        return {
+            file_name: f"{self.credentials_dir}/{file_name}"
+            for file_name in self._worker_credentials
+        }
+
+    def scale(  # type: ignore[no-untyped-def, override]
+        self, n=None, jobs=0, memory=None, cores=None
+    ):
+        """Scale cluster to specified configurations, see JobQueueCluster.scale
+
+        With an ``overprovision_factor`` above one, more jobs than asked for
+        are submitted when scaling up to a number of workers or jobs: the
+        increase over the current target is multiplied by the factor. Until
+        the target is met, asking for it again (e.g. by ``adapt``) changes
+        nothing. Workers of warm pilots adopted with ``from_name`` do not
+        count towards ``n``.
+        """
+        if self.overprovision_factor <= 1 or memory is not None or cores is not None:
+            self._scale_target = None
+            return super().scale(n, jobs=jobs, memory=memory, cores=cores)
+
+        processes = self._dummy_job.worker_processes
+        if n is not None:
+            jobs = int(math.ceil(n / processes))
+        if self._scale_target is None:
+            target = len(self.worker_spec)
+        elif jobs == self._scale_target[0]:
+            return None
+        else:
+            target = self._scale_target[0]
+        if jobs > target:
+            self._scale_target = (jobs, jobs * processes, time.monotonic())
+            increase = int(math.ceil((jobs - target) * self.overprovision_factor))
+            jobs = len(self.worker_spec) + increase
+        else:
+            self._scale_target = None
+        return super().scale(jobs=jobs)
+
+    def _update_worker_status(self, op, msg):  # type: ignore[no-untyped-def]
+        super()._update_worker_status(op, msg)
+        if op != "add" or self._scale_target is None:
+            return
+        jobs, workers, started_at = self._scale_target
+        if len(self.scheduler_info["workers"]) < workers:
+            return
+        self._scale_target = None
+        self.time_to_target = time.monotonic() - started_at
+        logger.info("%d workers connected after %.1fs", workers, self.time_to_target)
+        self._futures.add(asyncio.ensure_future(self._cancel_surplus_jobs(jobs)))
+
+    async def _cancel_surplus_jobs(self, jobs: int) -> None:
+        """Cancel the latest jobs beyond ``jobs`` that have not started yet"""
+        surplus = len(self.worker_spec) - jobs
+        if surplus <= 0 or self._job_monitor is None:
+            return
+        job_ids = {
+            name: job.job_id
+            for name, job in self.workers.items()
+            if getattr(job, "job_id", None)
+        }
+        statuses = await self._job_monitor.update(list(job_ids.values()))
+        not_started = [
+            name
+            for name in reversed(list(self.worker_spec))
+            if name in job_ids and statuses.get(job_ids[name]) not in STARTED_JOB_STATES
+        ]
+        logger.info("Cancelling %d surplus jobs", min(surplus, len(not_started)))
+        for name in not_started[:surplus]:
+            del self.worker_spec[name]
+        await self._correct_state()
+
+    async def _start(self) -> None:
+        # DiracJob settings are the same for all jobs of the cluster
+        settings = self._dummy_job._dirac_settings()  # pylint: disable=protected-access
+        self._dirac_client = AsyncDiracClient(settings)
+        self._job_kwargs["dirac_client"] = self._dirac_client
+        self._job_monitor = JobStatusMonitor(self._dirac_client)
+        self.periodic_callbacks["dirac-job-status"] = PeriodicCallback(
+            self._update_job_status, self.status_interval * 1000
         )
-        if hash_tuple[0] in cached_files:
-            return (load_from_parquet, hash_tuple[0], cache_location)
-        return (save_to_parquet, hash_tuple[0], (func_tuple), cache_location)
-
-    # Get to the deepest level and replace
-    if isinstance(hash_tuple, tuple) and isinstance(func_tuple, tuple):
-        current_hash, nested_hash = hash_tuple
-        current_func, nested_func = func_tuple
-
-        if current_hash in cached_files:
-            return (load_from_parquet, current_hash, cache_location)
-        # Recursively process the nested tuple
-        modified_nested_func = check_functions_and_hashes(
-            nested_func, nested_hash, cache_location
+        if self._worker_credentials:
+            await self._upload_credentials()
+        await super()._start()
+        if self.rendezvous:
+            await self._publish_rendezvous()
+
+    async def _publish_rendezvous(self) -> None:
+        """Write the address of the scheduler to the rendezvous file"""
+        scheme, _ = parse_address(self.scheduler_address)
+        _, port = get_address_host_port(self.scheduler_address)
+        host = await self._dummy_job.public_address()
+        address = f"{scheme}://{host}:{port}"
+        await self._client().call(
+            write_rendezvous,
+            self.rendezvous,
+            address,
+            self.name,
+            self.worker_credentials,
         )
-        return (
-            save_to_parquet,
-            current_hash,
-            (current_func, modified_nested_func),
-            cache_location,
+        logger.info("Published %s to rendezvous file %s", address, self.rendezvous)
+
+    async def _upload_credentials(self) -> None:
+        """Upload the TLS files of the workers to ``credentials_dir``"""
+        lfns = self.worker_credentials
+        client = self._client()
+        results = await asyncio.gather(
+            *(
+                client.call(
+                    upload_text,
+                    lfns[name],
+                    text,
+                    CREDENTIALS_MODE,
+                    self.allow_unrestricted_credentials,
+                )
+                for name, text in self._worker_credentials.items()
+            ),
+            return_exceptions=True,
         )
-
-    # Base case: No more nested tuples
-    if hash_tuple in cached_files:
-        return (load_from_parquet, hash_tuple, cache_location)
-    return (save_to_parquet, hash_tuple, (func_tuple), cache_location)
-
-
-def generate_hash_from_value(value: tuple[Callable[..., Any]]) -> tuple[str, Any]:
-    """Generate hash from value"""
-    if isinstance(value, tuple):
-        this_tuple = None
-
-        # Catch when there is no left and right as at end of chain
-        if len(value) == 1:
-            left = value[0]
-            right = ""
-        else:
-            left = value[0]
-            right = value[1:]
-            if len(right) == 1:
-                right = right[0]
-
-        logging.debug("left: %s", left)
-        logging.debug("right: %s", right)
-
-        # Process left side
-        if callable(left):
-            try:
-                left_name = left.__name__
-            except BaseException:  # noqa: B036
-                # Lets assume it's functools.partial for now
-                left_name = type(left).__name__
-        else:
-            left_name = str(left)
-
-        # Process right side
-        if isinstance(right, tuple):
-            logging.debug("rerunning function...\nleft: %s\nright: %s", left, right)
-            right_hash, this_tuple = generate_hash_from_value(right)
-        else:
-            if callable(right):
-                if hasattr(right, "__name__"):
-                    right_name = right.__name__
-                elif hasattr(right, "file"):
-                    # if FileMeta for AGC will end up here
-                    right_name = right.file
-                else:
-                    right_name = type(right).__name__
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            # do not leave credentials readable by others on the storage
+            await self._remove_credentials()
+            raise errors[0]
+        logger.info("Uploaded worker credentials to %s", self.credentials_dir)
+
+    async def _remove_credentials(self) -> None:
+        """Delete the TLS files of the workers from ``credentials_dir``"""
+        lfns = list(self.worker_credentials.values())
+        results = await self._client().map(_dirac.delete_file, [(lfn,) for lfn in lfns])
+        for lfn, result in zip(lfns, results):
+            if not result.get("OK", False):
+                logger.warning("Could not remove %s: %s", lfn, result.get("Message"))
+
+    async def _close(self) -> None:
+        if self.rendezvous:
+            # leave the pilots running for the next cluster
+            for job in self.workers.values():
+                job.job_id = None
+        await super()._close()
+        if self._worker_credentials:
+            await self._remove_credentials()
+        if self._dirac_client is not None:
+            # does not wait for running queries, so the loop is not blocked
+            self._dirac_client.close()
+
+    def _client(self) -> AsyncDiracClient:
+        """Client shared by the cluster and its jobs"""
+        if self._dirac_client is None:
+            # the cluster has not started, use the client of the jobs
+            job: DiracJob = self._dummy_job
+            return job._client()  # pylint: disable=protected-access
+        return self._dirac_client
+
+    @property
+    def job_status(self) -> dict[str, str]:
+        """DIRAC status of the job of each worker, as of the last update"""
+        statuses = self._job_monitor.statuses if self._job_monitor else {}
+        return {
+            name: statuses[job.job_id]
+            for name, job in self.workers.items()
+            if getattr(job, "job_id", None) in statuses
+        }
+
+    async def _update_job_status(self) -> None:
+        if self._job_monitor is None:
+            return
+        jobs = {
+            name: job
+            for name, job in self.workers.items()
+            if getattr(job, "job_id", None)
+        }
+        try:
+            statuses = await self._job_monitor.update(
+                [job.job_id for job in jobs.values()]
+            )
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.warning("Could not update the status of jobs", exc_info=True)
+            return
+        self.site_statistics.observe(statuses)
+
+        now = time.monotonic()
+        self._queued_since = {
+            job_id: self._queued_since.get(job_id, now)
+            for job_id, status in statuses.items()
+            if status not in STARTED_JOB_STATES and status not in ENDED_JOB_STATES
+        }
+        replaced = 0
+        for name, job in jobs.items():
+            status = statuses.get(job.job_id)
+            if name not in self.worker_spec:
+                continue
+            if status in ENDED_JOB_STATES:
+                reason = status
+            elif (
+                self.queue_timeout is not None
+                and now - self._queued_since.get(job.job_id, now) > self.queue_timeout
+            ):
+                reason = f"{status} for more than {self.queue_timeout:.0f}s"
+                self.site_statistics.timed_out(job.job_id)
             else:
-                right_name = str(right)
-            right_hash = right_name
-
-        # Combine the names/hashes for final hash
-        combined = left_name + right_hash
-        final_hash = hashlib.sha3_384(combined.encode()).hexdigest()
-        # TODO: Integrate with DiracClient
-        if this_tuple is not None:
-            hash_tuple = (final_hash, this_tuple)
-        else:
-            hash_tuple = final_hash
-
-        logging.debug(
-            "hash inputs: %s\nhash inputs: %s + %s\nhash: %s\nhash tuple: %s",
-            value,
-            left_name,
-            right_hash,
-            final_hash,
-            hash_tuple,
-        )
-
-        return final_hash, hash_tuple
+                continue
+            logger.info("Replacing job %s of worker %s (%s)", job.job_id, name, reason)
+            if status in ENDED_JOB_STATES and status != "Stalled":
+                # the job has ended, there is nothing to cancel when it is closed
+                job.job_id = None
+            # named while the old spec is still there, so the name is not reused
+            new_spec = self.new_worker_spec()
+            del self.worker_spec[name]
+            self.worker_spec.update(new_spec)
+            replaced += 1
+        if replaced:
+            await self._correct_state()
 
-    # should in theory never reach here
-    return str(value), str(value)
-
-
-def save_to_parquet(
-    filename: str, data: pd.DataFrame, cache_location: str
-) -> pd.DataFrame:
-    """Save data to Parquet file.
-    TODO: Make more generic than dataframe.
-    """
-
-    logging.debug("Writing stage to: %s/%s.parquet", cache_location, filename)
-
-    # ensure dataframe columns have names
-    if not isinstance(data, pd.DataFrame):
-        data = pd.DataFrame(data)
-    if not all(isinstance(col, str) for col in data.columns):
-        data.columns = [f"col_{i}" for i in range(data.shape[1])]
-
-    if cache_location.startswith("file://"):
-        cache_location = cache_location[len("file://") :]
-        # make sure the directory exists
-        os.makedirs(cache_location, exist_ok=True)
-        name = cache_location + "/" + filename + ".parquet"
-        data.to_parquet(name)
-        return data
-
-    # TODO: RUCIO
-    # TODO: DIRAC
-    raise NotImplementedError(f"Caching is not implemented yet for {cache_location}")
-
-
-def load_from_parquet(filename: str, cache_location: str) -> pd.DataFrame:
-    """Load data from Parquet file."""
-    logging.debug("Loading cached file: %s/%s.parquet", cache_location, filename)
-
-    if cache_location.startswith("file://"):
-        cache_location = cache_location[len("file://") :]
-        name = cache_location + "/" + filename + ".parquet"
-        return pd.read_parquet(name)
-
-    # TODO: RUCIO
-    # TODO: DIRAC
-    raise NotImplementedError(f"Caching is not implemented yet for {cache_location}")
-
-
-def get_cached_files(cache_location: str) -> list[str]:
-    """Get cached filed from cache location"""
-
-    if cache_location.startswith("file://"):
-        cache_location = cache_location[len("file://") :]
-        file_list = glob.glob(cache_location + "/*.parquet")
-        # remove parquet extension and get file name from path
-        file_list = [c[c.rfind("/") + 1 : -8] for c in file_list]
-        return file_list
-    if cache_location.startswith("dirac://"):
-        cache_location = cache_location[len("dirac://") :]
-        # Hardcode for now
-        server_url = "https://diracdev.grid.hep.ph.ic.ac.uk:8444"
-        capath = "/cvmfs/grid.cern.ch/etc/grid-security/certificates/"
-        user_proxy = "/tmp/x509up_u397871"
-        settings = _dirac.DiracSettings(server_url, capath, user_proxy)
-        result = _dirac.get_directory_dump(settings, cache_location)
-        file_list = _dirac.get_directory_success_files(result)
-        file_list = [file for file in file_list if file.endswith(".parquet")]
-        file_list = [c[c.rfind("/") + 1 : -8] for c in file_list]
-        return file_list
-
-    # TODO: RUCIO
-    # TODO: DIRAC
-    raise NotImplementedError(f"Caching is not implemented yet for {cache_location}")
+    @classmethod
+    def from_name(  # type: ignore[override]
+        cls, name: str, **kwargs: Any
+    ) -> DiracCluster:
+        """Start a cluster that takes over the pilots of rendezvous file ``name``
+
+        The workers of pilots left by earlier clusters with the same
+        ``rendezvous`` connect as soon as the pilots see the new address (they
+        check every 30s by default), without new jobs having to be submitted.
+        Use ``scale`` to add more pilots.
+
+        The cluster has no jobs for these warm pilots, so ``scale(n)`` submits
+        ``n`` new pilots on top of them rather than counting their workers,
+        and ``cluster.scale(0)`` does not stop them. ``adapt`` sees their
+        workers on the scheduler and may retire them; a pilot whose workers
+        are retired does not start new ones for the same scheduler and exits
+        after its ``pilot_idle_timeout``. Pass ``minimum`` to ``adapt`` to keep
+        the warm workers, or scale explicitly.
+        """
+        return cls(rendezvous=name, **kwargs)
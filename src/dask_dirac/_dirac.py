@@ -5,10 +5,12 @@ since we might want to move it to a standalone dirac client
 
 from __future__ import annotations
 
+import errno
 import json
 import os
+import threading
 import zlib
-from collections.abc import Generator
+from collections.abc import Generator, Sequence
 from dataclasses import dataclass
 from typing import Any
 
@@ -19,6 +21,14 @@ try:
 except ImportError:
     gfal2 = None
 import requests
+from requests.adapters import HTTPAdapter
+
+# For now put everything under swift-hep at RAL site
+STORAGE_BASE_URL = "https://mover.pp.rl.ac.uk:2880/pnfs/pp.rl.ac.uk/data"
+
+
+DEFAULT_SERVER_URL = "https://diracdev.grid.hep.ph.ic.ac.uk:8444"
+DEFAULT_CAPATH = "/cvmfs/grid.cern.ch/etc/grid-security/certificates/"
 
 
 @dataclass
@@ -26,11 +36,93 @@ class DiracSettings:
     """Settings for DIRAC queries"""
 
     server_url: str  # TODO: add validator
-    capath: str = "/cvmfs/grid.cern.ch/etc/grid-security/certificates/"
+    capath: str = DEFAULT_CAPATH
     user_proxy: str = ""
     query_url: str = ""
 
 
+def settings_from_environment(server_url: str | None = None) -> DiracSettings:
+    """Settings for the current user
+
+    The server is taken from ``DIRAC_SERVER_URL``, the certificates from
+    ``X509_CERT_DIR`` and the proxy from ``X509_USER_PROXY``, falling back to
+    the usual ``/tmp/x509up_u<uid>``.
+    """
+    return DiracSettings(
+        server_url or os.environ.get("DIRAC_SERVER_URL", DEFAULT_SERVER_URL),
+        capath=os.environ.get("X509_CERT_DIR", DEFAULT_CAPATH),
+        user_proxy=os.environ.get("X509_USER_PROXY", f"/tmp/x509up_u{os.getuid()}"),
+    )
+
+
+class DiracHTTPClient:
+    """Keep-alive HTTPS sessions to DIRAC servers
+
+    One ``requests.Session`` is kept per server, proxy and CA path, so that
+    consecutive queries reuse open connections instead of doing a new TLS
+    handshake each time. ``pool_maxsize`` is the number of connections kept
+    open to each server, which bounds the number of concurrent queries that
+    don't have to wait for a connection.
+    """
+
+    def __init__(self, pool_maxsize: int = 10, timeout: float = 60) -> None:
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self._sessions: dict[tuple[str, str, str], requests.Session] = {}
+        self._lock = threading.Lock()
+
+    def session(self, settings: DiracSettings) -> requests.Session:
+        """Session for the server and credentials of ``settings``"""
+        key = (settings.server_url, settings.user_proxy, settings.capath)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_maxsize=self.pool_maxsize)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[key] = session
+        return session
+
+    def post(self, settings: DiracSettings, params: dict[str, str]) -> Any:
+        """POST ``params`` to ``settings.query_url`` and return the JSON reply"""
+        session = self.session(settings)
+        result = session.post(
+            settings.query_url,
+            data=params,
+            cert=settings.user_proxy or None,
+            verify=settings.capath,
+            timeout=self.timeout,
+        )
+        return result.json()
+
+    def close(self) -> None:
+        """Close all sessions"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
+
+_http_client = DiracHTTPClient()
+
+
+def get_http_client() -> DiracHTTPClient:
+    """Client used by the query functions of this module"""
+    return _http_client
+
+
+def set_http_client(client: DiracHTTPClient) -> DiracHTTPClient:
+    """Route the query functions of this module through ``client``
+
+    Returns the client that was used before, which is not closed.
+    """
+    global _http_client  # pylint: disable=global-statement
+    previous, _http_client = _http_client, client
+    return previous
+
+
 def _set_defaults(settings: DiracSettings, params: dict[str, str]) -> dict[str, str]:
     if "diracdev.grid.hep.ph.ic.ac.uk" in settings.query_url:
         params["clientSetup"] = params.get("clientSetup", "GridPP")
@@ -40,14 +132,7 @@ def _set_defaults(settings: DiracSettings, params: dict[str, str]) -> dict[str,
 def _query(settings: DiracSettings, params: dict[str, str]) -> Any:
     params = _set_defaults(settings, params)
 
-    result = requests.post(
-        settings.query_url,
-        data=params,
-        cert=settings.user_proxy,
-        verify=settings.capath,
-        timeout=60,
-    )
-    return result.json()
+    return _http_client.post(settings, params)
 
 
 def submit_job(settings: DiracSettings, jdl: str) -> Any:
@@ -58,6 +143,28 @@ def submit_job(settings: DiracSettings, jdl: str) -> Any:
     return _query(settings, params)
 
 
+def kill_jobs(settings: DiracSettings, job_ids: Sequence[int | str]) -> Any:
+    """Kill jobs on a DIRAC server"""
+    endpoint = "WorkloadManagement/JobManager"
+    settings.query_url = f"{settings.server_url}/{endpoint}"
+    params = {
+        "method": "killJob",
+        "args": json.dumps([[int(job_id) for job_id in job_ids]]),
+    }
+    return _query(settings, params)
+
+
+def delete_jobs(settings: DiracSettings, job_ids: Sequence[int | str]) -> Any:
+    """Delete jobs from a DIRAC server"""
+    endpoint = "WorkloadManagement/JobManager"
+    settings.query_url = f"{settings.server_url}/{endpoint}"
+    params = {
+        "method": "deleteJob",
+        "args": json.dumps([[int(job_id) for job_id in job_ids]]),
+    }
+    return _query(settings, params)
+
+
 def get_jobs(settings: DiracSettings) -> Any:
     """Get jobs from DIRAC server"""
     endpoint = "WorkloadManagement/JobMonitoring"
@@ -66,6 +173,17 @@ def get_jobs(settings: DiracSettings) -> Any:
     return _query(settings, params)
 
 
+def get_jobs_status(settings: DiracSettings, job_ids: Sequence[int | str]) -> Any:
+    """Get the status of many jobs from DIRAC server in one query"""
+    endpoint = "WorkloadManagement/JobMonitoring"
+    settings.query_url = f"{settings.server_url}/{endpoint}"
+    params = {
+        "method": "getJobsStatus",
+        "args": json.dumps([[int(job_id) for job_id in job_ids]]),
+    }
+    return _query(settings, params)
+
+
 def get_max_parametric_jobs(settings: DiracSettings) -> Any:
     """Get max parametric jobs from DIRAC server (mostly for testing)"""
     endpoint = "WorkloadManagement/JobManager"
@@ -95,10 +213,26 @@ def get_directory_success_files(result: Any) -> list[str]:
     return all_successful_files
 
 
-def get_directory_dump(settings: DiracSettings, lfns: str) -> Any:
-    """Get directory dump from DIRAC server"""
+def get_failed_paths(result: Any) -> dict[str, Any]:
+    """Paths a bulk FileCatalog method failed for, with their errors
+
+    Bulk methods return OK even if they failed for some or all paths.
+    """
+    value = result.get("Value") if result.get("OK", False) else None
+    if not isinstance(value, dict):
+        return {}
+    return dict(value.get("Failed") or {})
+
+
+def get_directory_dump(settings: DiracSettings, lfns: str | list[str]) -> Any:
+    """Get directory dump from DIRAC server
+
+    Several directories can be listed in one request by passing a list.
+    """
     endpoint = "DataManagement/FileCatalog"
     settings.query_url = f"{settings.server_url}/{endpoint}"
+    if isinstance(lfns, str):
+        lfns = [lfns]
     params = {"method": "getDirectoryDump", "args": json.dumps([lfns])}
     return _query(settings, params)
 
@@ -127,6 +261,14 @@ def remove_file(settings: DiracSettings, lfns: str) -> Any:
     return _query(settings, params)
 
 
+def change_path_mode(settings: DiracSettings, lfns: str, mode: int) -> Any:
+    """Change the permissions of a file or directory in the FileCatalog"""
+    endpoint = "DataManagement/FileCatalog"
+    settings.query_url = f"{settings.server_url}/{endpoint}"
+    params = {"method": "changePathMode", "args": json.dumps([{lfns: mode}])}
+    return _query(settings, params)
+
+
 def get_file(settings: DiracSettings, lfns: str) -> Any:
     """Download a file from DIRAC server"""
     endpoint = "DataManagement/FileCatalog"
@@ -164,20 +306,42 @@ def _adler32(file_path: str) -> str:
     return adler_hex
 
 
+def _gfal2_context(settings: DiracSettings) -> Any:
+    """Create a gfal2 context authenticating with the user proxy"""
+    if gfal2 is None:
+        raise ImportError("gfal2 is required to transfer files to and from storage")
+    context = gfal2.creat_context()
+    if settings.user_proxy:
+        context.set_opt_string("X509", "CERT", settings.user_proxy)
+        context.set_opt_string("X509", "KEY", settings.user_proxy)
+    return context
+
+
+def download_file(settings: DiracSettings, remote_file: str, local_file: str) -> None:
+    """Download a file uploaded with add_file to a local path"""
+    source = f"{STORAGE_BASE_URL}{remote_file}"
+    destination = f"file://{local_file}"
+    context = _gfal2_context(settings)
+
+    params = context.transfer_parameters()
+    params.overwrite = True
+
+    context.filecopy(params, source, destination)
+
+
 def add_file(
     settings: DiracSettings, local_file: str, remote_file: str, overwrite: bool
 ) -> Any:
     """Add file to directory on DIRAC server"""
     # example: https://github.com/cern-fts/gfal2-python/blob/develop/example/python/gfal2_copy.py
-    # For now put everything under swift-hep at RAL site
-    base_destination = "https://mover.pp.rl.ac.uk:2880/pnfs/pp.rl.ac.uk/data"
 
     # upload the file to server
-    destination = f"{base_destination}{remote_file}"
+    destination = f"{STORAGE_BASE_URL}{remote_file}"
     source = f"file://{local_file}"
-    context = gfal2.creat_context()
+    context = _gfal2_context(settings)
 
     params = context.transfer_parameters()
+    params.create_parent = True
 
     if overwrite:
         params.overwrite = True
@@ -203,3 +367,27 @@ def add_file(
     params = {"method": "addFile", "args": json.dumps([lfns])}
 
     return _query(settings, params)
+
+
+def chmod_file(settings: DiracSettings, remote_file: str, mode: int) -> None:
+    """Change the permissions of a file uploaded with add_file on the storage"""
+    context = _gfal2_context(settings)
+    context.chmod(f"{STORAGE_BASE_URL}{remote_file}", mode)
+
+
+def delete_file(settings: DiracSettings, remote_file: str) -> Any:
+    """Delete a file uploaded with add_file from the storage and the catalog
+
+    ``remove_file`` only removes the catalog entry. If the replica can not be
+    deleted, the entry is kept so that the file can still be found.
+    """
+    try:
+        _gfal2_context(settings).unlink(f"{STORAGE_BASE_URL}{remote_file}")
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        if getattr(exc, "code", None) != errno.ENOENT:
+            return {"OK": False, "Message": f"Could not delete replica: {exc}"}
+    result = remove_file(settings, remote_file)
+    failed = get_failed_paths(result)
+    if failed:
+        return {"OK": False, "Message": f"Could not remove entry: {failed}"}
+    return result
@@ -0,0 +1,107 @@
+"""Asyncio interface to the HTTP DIRAC queries
+
+The queries in ``_dirac`` block on the network. ``AsyncDiracClient`` runs
+them in a thread pool, so that they can be awaited from an event loop (for
+example the one of a ``DiracCluster``) without blocking it, and so that many
+of them can be in flight at once.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import functools
+from collections.abc import Callable, Iterable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from . import _dirac
+
+
+class AsyncDiracClient:
+    """Await DIRAC queries with bounded concurrency
+
+    At most ``max_concurrency`` queries run at the same time; further queries
+    wait for a free slot. The queries go through the pooled keep-alive
+    sessions of ``_dirac.DiracHTTPClient``, whose pool should be at least
+    ``max_concurrency`` connections wide to avoid waiting for connections.
+
+    >>> client = AsyncDiracClient(settings)
+    >>> statuses = await client.map(_dirac.get_jobs, [()] * 10)
+    """
+
+    def __init__(
+        self, settings: _dirac.DiracSettings, max_concurrency: int = 10
+    ) -> None:
+        self.settings = settings
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(
+            max_concurrency, thread_name_prefix="dask-dirac-query"
+        )
+        self._semaphore: asyncio.Semaphore | None = None
+
+    async def call(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Run ``func(settings, *args)`` from ``_dirac`` in the thread pool"""
+        if self._semaphore is None:
+            # created here so that it belongs to the running loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        # the query functions set query_url on their settings, so concurrent
+        # queries each need their own copy
+        settings = dataclasses.replace(self.settings)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(func, settings, *args)
+            )
+
+    async def map(
+        self, func: Callable[..., Any], args: Iterable[tuple[Any, ...]]
+    ) -> list[Any]:
+        """Run ``func`` once for every tuple of arguments, concurrently"""
+        return list(await asyncio.gather(*(self.call(func, *a) for a in args)))
+
+    async def submit_job(self, jdl: str) -> Any:
+        """Submit a job to a DIRAC server"""
+        return await self.call(_dirac.submit_job, jdl)
+
+    async def kill_jobs(self, job_ids: Sequence[int | str]) -> Any:
+        """Kill jobs on a DIRAC server"""
+        return await self.call(_dirac.kill_jobs, job_ids)
+
+    async def delete_jobs(self, job_ids: Sequence[int | str]) -> Any:
+        """Delete jobs from a DIRAC server"""
+        return await self.call(_dirac.delete_jobs, job_ids)
+
+    async def get_jobs(self) -> Any:
+        """Get jobs from DIRAC server"""
+        return await self.call(_dirac.get_jobs)
+
+    async def get_jobs_status(self, job_ids: Sequence[int | str]) -> Any:
+        """Get the status of many jobs from DIRAC server in one query"""
+        return await self.call(_dirac.get_jobs_status, job_ids)
+
+    async def get_max_parametric_jobs(self) -> Any:
+        """Get max parametric jobs from DIRAC server"""
+        return await self.call(_dirac.get_max_parametric_jobs)
+
+    async def whoami(self) -> Any:
+        """Get user info from DIRAC server"""
+        return await self.call(_dirac.whoami)
+
+    async def get_directory_dump(self, lfns: str | list[str]) -> Any:
+        """Get directory dump from DIRAC server"""
+        return await self.call(_dirac.get_directory_dump, lfns)
+
+    def close(self) -> None:
+        """Shut down the thread pool
+
+        Does not wait for the queries that are running, so that it can be
+        called from an event loop; they finish in the background.
+        """
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self) -> AsyncDiracClient:
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        self.close()
@@ -0,0 +1,158 @@
+"""Long-lived pilot jobs that serve one scheduler after another
+
+A pilot is a grid job that, instead of starting a worker for a fixed
+scheduler, reads the address of the current scheduler from a rendezvous file
+in the DIRAC FileCatalog. When that scheduler goes away, its workers exit and
+the pilot waits for a new address to appear in the file. A new
+``DiracCluster`` that writes its address to the same file gets the workers of
+the pilots that are still waiting, without going through the grid queue.
+
+If the cluster uses TLS, the pilot downloads the worker credentials of each
+new scheduler before starting its workers.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from collections.abc import Mapping, Sequence
+from typing import Any
+
+from dask.utils import tmpfile
+
+from . import _dirac
+
+logger = logging.getLogger(__name__)
+
+
+def upload_text(
+    settings: _dirac.DiracSettings,
+    lfn: str,
+    text: str,
+    mode: int | None = None,
+    allow_unrestricted_replica: bool = False,
+) -> None:
+    """Write ``text`` to the file ``lfn``, replacing it if it exists
+
+    With ``mode``, the permissions of the file are then set to ``mode`` in
+    the FileCatalog and on its replica. If the storage element can not change
+    the permissions of the replica, RuntimeError is raised unless
+    ``allow_unrestricted_replica`` is set.
+    """
+    # the local copy is created readable by the owner only
+    with tempfile.NamedTemporaryFile(
+        mode="w", encoding="utf-8", suffix=os.path.basename(lfn)
+    ) as local_file:
+        local_file.write(text)
+        local_file.flush()
+        result = _dirac.add_file(settings, local_file.name, lfn, True)
+    if not result.get("OK", False):
+        raise RuntimeError(f"Could not upload {lfn}: {result.get('Message', result)}")
+    if mode is None:
+        return
+    result = _dirac.change_path_mode(settings, lfn, mode)
+    if not result.get("OK", False) or _dirac.get_failed_paths(result):
+        raise RuntimeError(f"Could not restrict {lfn}: {result.get('Message', result)}")
+    try:
+        _dirac.chmod_file(settings, lfn, mode)
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        # e.g. the HTTP interface of the storage element has no chmod
+        if not allow_unrestricted_replica:
+            raise RuntimeError(
+                f"Could not restrict the replica of {lfn} on storage: {exc}"
+            ) from exc
+        logger.warning(
+            "Could not restrict the replica of %s on storage", lfn, exc_info=True
+        )
+
+
+def write_rendezvous(
+    settings: _dirac.DiracSettings,
+    lfn: str,
+    address: str,
+    name: str,
+    credentials: Mapping[str, str] | None = None,
+) -> None:
+    """Publish ``address`` of the scheduler of cluster ``name`` to ``lfn``
+
+    ``credentials`` maps the names of the TLS files the workers use to the
+    LFNs they are downloaded from.
+    """
+    rendezvous = {
+        "address": address,
+        "name": name,
+        "started": time.time(),
+        "credentials": dict(credentials or {}),
+    }
+    upload_text(settings, lfn, json.dumps(rendezvous))
+
+
+def read_rendezvous(settings: _dirac.DiracSettings, lfn: str) -> dict[str, Any]:
+    """Read the scheduler published in ``lfn``"""
+    with tmpfile(extension="json") as local_file:
+        _dirac.download_file(settings, lfn, local_file)
+        with open(local_file, encoding="utf-8") as file_handle:
+            rendezvous: dict[str, Any] = json.load(file_handle)
+    return rendezvous
+
+
+def download_credentials(
+    settings: _dirac.DiracSettings, credentials: Mapping[str, str]
+) -> None:
+    """Download the ``credentials`` of a scheduler to the working directory"""
+    for file_name, lfn in credentials.items():
+        _dirac.download_file(settings, lfn, os.path.abspath(file_name))
+
+
+def run_worker(address: str, worker_args: Sequence[str], death_timeout: str) -> int:
+    """Run ``dask worker`` until it exits, which it does once the scheduler
+    has been gone for ``death_timeout``"""
+    command = ["dask", "worker", address, "--death-timeout", death_timeout]
+    return subprocess.run([*command, *worker_args], check=False).returncode
+
+
+def run_pilot(
+    settings: _dirac.DiracSettings,
+    lfn: str,
+    worker_args: Sequence[str] = (),
+    idle_timeout: float = 1800,
+    poll_interval: float = 30,
+    death_timeout: str = "60s",
+) -> None:
+    """Run workers for every scheduler published in ``lfn``
+
+    Returns once no new scheduler has been published for ``idle_timeout``
+    seconds after the last worker exited.
+    """
+    served: tuple[Any, Any] | None = None
+    idle_since = time.monotonic()
+    while time.monotonic() - idle_since < idle_timeout:
+        try:
+            rendezvous = read_rendezvous(settings, lfn)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.warning("Could not read rendezvous file %s", lfn, exc_info=True)
+            rendezvous = {}
+        # a restarted scheduler can listen on the same address again
+        scheduler = (rendezvous.get("address"), rendezvous.get("started"))
+        if scheduler[0] and scheduler != served:
+            address = scheduler[0]
+            try:
+                download_credentials(settings, rendezvous.get("credentials") or {})
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.warning("Could not download credentials", exc_info=True)
+                time.sleep(poll_interval)
+                continue
+            logger.info(
+                "Starting workers for %s at %s", rendezvous.get("name"), address
+            )
+            returncode = run_worker(address, worker_args, death_timeout)
+            logger.info("Workers exited with %d", returncode)
+            served = scheduler
+            idle_since = time.monotonic()
+            continue
+        time.sleep(poll_interval)
+    logger.info("No new scheduler for %ds, stopping", idle_timeout)
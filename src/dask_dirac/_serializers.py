@@ -0,0 +1,189 @@
+"""Serialization formats for the result cache
+
+Every cached result is stored with the serializer registered for its type:
+pandas DataFrames as Arrow IPC files, numpy arrays as .npy files, awkward
+arrays as parquet, and anything else with pickle.
+"""
+
+from __future__ import annotations
+
+import pickle
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Any
+
+from dask.utils import Dispatch
+
+
+@dataclass(frozen=True)
+class Serializer:
+    """How results are written to and read from a cache file
+
+    ``load_mapped``, if set, loads a file by memory-mapping it instead of
+    reading it. The result is read-only and shares memory with the page cache.
+    """
+
+    name: str
+    extension: str
+    dump: Callable[[Any, str], None]
+    load: Callable[[str], Any]
+    load_mapped: Callable[[str], Any] | None = None
+
+
+def _dump_pickle(data: Any, path: str) -> None:
+    with open(path, "wb") as output_file:
+        pickle.dump(data, output_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load_pickle(path: str) -> Any:
+    with open(path, "rb") as input_file:
+        return pickle.load(input_file)
+
+
+def _dump_arrow(data: Any, path: str) -> None:
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(data)
+    with (
+        pa.OSFile(path, "wb") as output_file,
+        pa.ipc.new_file(output_file, table.schema) as writer,
+    ):
+        writer.write_table(table)
+
+
+def _load_arrow(path: str) -> Any:
+    import pyarrow as pa
+
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+def _load_arrow_mapped(path: str) -> Any:
+    import pyarrow as pa
+
+    # primitive columns without nulls are converted without a copy, so they
+    # keep referencing (and keep open) the memory map
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    return table.to_pandas(split_blocks=True)
+
+
+def _dump_pandas_parquet(data: Any, path: str) -> None:
+    data.to_parquet(path)
+
+
+def _load_pandas_parquet(path: str) -> Any:
+    import pandas as pd
+
+    return pd.read_parquet(path)
+
+
+def _dump_numpy(data: Any, path: str) -> None:
+    import numpy as np
+
+    with open(path, "wb") as output_file:
+        np.save(output_file, data, allow_pickle=False)
+
+
+def _load_numpy(path: str) -> Any:
+    import numpy as np
+
+    return np.load(path, allow_pickle=False)
+
+
+def _load_numpy_mapped(path: str) -> Any:
+    import numpy as np
+
+    return np.asarray(np.load(path, mmap_mode="r", allow_pickle=False))
+
+
+def _dump_awkward(data: Any, path: str) -> None:
+    import awkward as ak
+
+    ak.to_parquet(data, path)
+
+
+def _load_awkward(path: str) -> Any:
+    import awkward as ak
+
+    return ak.from_parquet(path)
+
+
+PICKLE = Serializer("pickle", ".pkl", _dump_pickle, _load_pickle)
+ARROW = Serializer("arrow", ".arrow", _dump_arrow, _load_arrow, _load_arrow_mapped)
+NUMPY = Serializer("numpy", ".npy", _dump_numpy, _load_numpy, _load_numpy_mapped)
+AWKWARD = Serializer("awkward", ".ak.parquet", _dump_awkward, _load_awkward)
+# cache entries written before there was a choice of formats
+PANDAS_PARQUET = Serializer(
+    "parquet", ".parquet", _dump_pandas_parquet, _load_pandas_parquet
+)
+
+_SERIALIZERS_BY_EXTENSION = {
+    serializer.extension: serializer
+    for serializer in (PICKLE, ARROW, NUMPY, AWKWARD, PANDAS_PARQUET)
+}
+
+# serializer to use for a result, dispatched on its type
+serializer_for = Dispatch(name="serializer_for")
+
+
+@serializer_for.register(object)
+def _serializer_for_object(data: Any) -> Serializer:
+    return PICKLE
+
+
+@serializer_for.register_lazy("pandas")
+def _register_pandas() -> None:
+    import pandas as pd
+
+    @serializer_for.register(pd.DataFrame)
+    def _serializer_for_dataframe(data: Any) -> Serializer:
+        return ARROW
+
+
+@serializer_for.register_lazy("numpy")
+def _register_numpy() -> None:
+    import numpy as np
+
+    @serializer_for.register(np.ndarray)
+    def _serializer_for_ndarray(data: Any) -> Serializer:
+        if data.dtype.hasobject:
+            return PICKLE
+        return NUMPY
+
+
+@serializer_for.register_lazy("awkward")
+def _register_awkward() -> None:
+    import awkward as ak
+
+    @serializer_for.register(ak.Array)
+    def _serializer_for_awkward(data: Any) -> Serializer:
+        return AWKWARD
+
+
+def register_serializer(serializer: Serializer) -> None:
+    """Make ``serializer`` available for reading cache files
+
+    Use ``serializer_for.register(cls)`` to also write results of type ``cls``
+    with it.
+    """
+    _SERIALIZERS_BY_EXTENSION[serializer.extension] = serializer
+
+
+def split_cache_file_name(file_name: str) -> tuple[str, str]:
+    """Split a cache file name into entry name and extension"""
+    name, dot, extension = file_name.partition(".")
+    return name, dot + extension
+
+
+def is_cache_file(file_name: str) -> bool:
+    """Whether ``file_name`` has the extension of a registered serializer"""
+    return split_cache_file_name(file_name)[1] in _SERIALIZERS_BY_EXTENSION
+
+
+def serializer_for_file(file_name: str) -> Serializer:
+    """Serializer that can read the cache file ``file_name``"""
+    _, extension = split_cache_file_name(file_name)
+    try:
+        return _SERIALIZERS_BY_EXTENSION[extension]
+    except KeyError:
+        raise ValueError(f"No serializer registered for {file_name}") from None
@@ -0,0 +1,96 @@
+"""Temporary TLS credentials for a DiracCluster
+
+``Security.temporary`` makes one key and self-signed certificate and uses
+them for every role, so the credentials of the workers are also those of the
+scheduler and the CA. The worker credentials of a ``DiracCluster`` are
+shipped to grid storage, so instead a temporary CA signs one certificate for
+the scheduler and client, which stays on this machine, and one for the
+workers. The key of the CA is only kept in memory while signing them.
+"""
+
+from __future__ import annotations
+
+import datetime
+from typing import Any
+
+from distributed.security import Security
+
+
+def temporary_security(
+    valid_for: datetime.timedelta = datetime.timedelta(days=30), **kwargs: Any
+) -> Security:
+    """Security with a temporary CA and separate worker credentials
+
+    ``kwargs`` are passed on to ``Security``. Requires ``cryptography``.
+    """
+    # pylint: disable=import-outside-toplevel
+    try:
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+    except ImportError:
+        raise ImportError(
+            "security=True requires `cryptography`, please install it using "
+            "either pip or conda"
+        ) from None
+
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    def new_key() -> Any:
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    def certificate(name: str, key: Any, issuer: Any, issuer_key: Any) -> Any:
+        subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)])
+        builder = (
+            x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(issuer.subject if issuer is not None else subject)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(minutes=5))
+            .not_valid_after(now + valid_for)
+            .add_extension(
+                x509.BasicConstraints(ca=issuer is None, path_length=None),
+                critical=True,
+            )
+        )
+        if issuer is not None:
+            builder = builder.add_extension(
+                x509.SubjectAlternativeName([x509.DNSName(name)]), critical=False
+            ).add_extension(
+                x509.ExtendedKeyUsage(
+                    [ExtendedKeyUsageOID.SERVER_AUTH, ExtendedKeyUsageOID.CLIENT_AUTH]
+                ),
+                critical=False,
+            )
+        return builder.sign(issuer_key, hashes.SHA256())
+
+    def pem(value: Any) -> str:
+        if isinstance(value, x509.Certificate):
+            return value.public_bytes(serialization.Encoding.PEM).decode()
+        return str(
+            value.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption(),
+            ).decode()
+        )
+
+    ca_key = new_key()
+    ca_cert = certificate("dask-dirac-ca", ca_key, None, ca_key)
+    scheduler_key, worker_key = new_key(), new_key()
+    scheduler_cert = certificate("dask-internal", scheduler_key, ca_cert, ca_key)
+    worker_cert = certificate("dask-internal", worker_key, ca_cert, ca_key)
+
+    kwargs.setdefault("require_encryption", True)
+    return Security(
+        tls_ca_file=pem(ca_cert),
+        tls_client_key=pem(scheduler_key),
+        tls_client_cert=pem(scheduler_cert),
+        tls_scheduler_key=pem(scheduler_key),
+        tls_scheduler_cert=pem(scheduler_cert),
+        tls_worker_key=pem(worker_key),
+        tls_worker_cert=pem(worker_cert),
+        **kwargs,
+    )
@@ -6,7 +6,7 @@ from typing import Any
 
 import typer
 
-from . import __version__, _dirac
+from . import __version__, _dirac, _pilot
 
 app = typer.Typer()
 
@@ -202,6 +202,33 @@ def add_file(
     typer.echo(result)
 
 
+@app.command(
+    context_settings={"allow_extra_args": True, "ignore_unknown_options": True}
+)
+def pilot(
+    ctx: typer.Context,
+    server_url: str,
+    rendezvous: str,
+    idle_timeout: float = typer.Option(
+        default=1800, help="seconds to wait for a new scheduler before exiting"
+    ),
+    poll_interval: float = typer.Option(
+        default=30, help="seconds between reads of the rendezvous file"
+    ),
+    death_timeout: str = typer.Option(
+        default="60s", help="how long workers wait for a scheduler that is gone"
+    ),
+) -> None:
+    """Run dask workers for the schedulers published in a rendezvous file
+
+    Arguments after "--" are passed on to "dask worker".
+    """
+    settings = _dirac.settings_from_environment(server_url)
+    _pilot.run_pilot(
+        settings, rendezvous, ctx.args, idle_timeout, poll_interval, death_timeout
+    )
+
+
 @app.command()
 def version() -> None:
     """Print the version number"""
@@ -15,6 +15,11 @@ def get_jinja_env() -> Environment:
     )
 
 
+@cache
 def get_template(template_name: str) -> Template:
-    """Attempts to retrieve template named {template_name}"""
+    """Attempts to retrieve template named {template_name}
+
+    Templates are compiled once; later calls return the same template without
+    checking the file for changes.
+    """
     return get_jinja_env().get_template(template_name)
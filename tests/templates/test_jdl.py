@@ -72,3 +72,28 @@ def test_submit_command_template_rendering(jinja_env):
     # Assertions
     expected_command = "dask-dirac submit test_url test_jdl_file --capath test_cert_path --user-proxy test_user_proxy --dask-script"
     assert result.strip() == expected_command
+
+
+def test_jdl_template_parameters(jinja_env):
+    template = jinja_env.get_template("jdl.j2")
+
+    result = template.render(owner="test_group", parameters=5)
+    assert "Parameters = 5;" in result
+    assert "ParameterStart = 0;" in result
+
+    assert "Parameters" not in template.render(owner="test_group")
+
+
+def test_jdl_template_multicore(jinja_env):
+    template = jinja_env.get_template("jdl.j2")
+
+    result = template.render(
+        owner="test_group", number_of_processors=16, max_ram=32768, whole_node=True
+    )
+    assert "NumberOfProcessors = 16;" in result
+    assert "MaxRAM = 32768;" in result
+    assert 'WholeNode = "yes";' in result
+
+    result = template.render(owner="test_group")
+    assert "NumberOfProcessors" not in result
+    assert "MaxRAM" not in result
@@ -0,0 +1,399 @@
+from __future__ import annotations
+
+import os
+from functools import partial
+from pathlib import Path
+
+import dask.config
+import numpy as np
+import pandas as pd
+import pytest
+
+import dask_dirac._cache as cache_module
+
+
+def test_cache_index(tmp_path):
+    (tmp_path / "abc.parquet").touch()
+    (tmp_path / "not_cached.txt").touch()
+
+    index = cache_module.CacheIndex(f"file://{tmp_path}")
+
+    assert "abc" in index
+    assert "not_cached" not in index
+    assert len(index) == 1
+
+    assert index.file_name("abc") == "abc.parquet"
+
+    (tmp_path / "ghi.parquet").touch()
+    assert "ghi" not in index
+    index.refresh()
+    assert "ghi" in index
+
+
+def test_check_functions_and_hashes_lists_cache_once(tmp_path, monkeypatch):
+    (tmp_path / "hash_b.parquet").touch()
+    cache_location = f"file://{tmp_path}"
+
+    calls = []
+    get_cache_entries = cache_module.get_cache_entries
+
+    def counting_get_cache_entries(location, dirac_settings=None):
+        calls.append(location)
+        return get_cache_entries(location, dirac_settings)
+
+    monkeypatch.setattr(cache_module, "get_cache_entries", counting_get_cache_entries)
+
+    index = cache_module.CacheIndex(cache_location)
+    missing = cache_module.check_functions_and_hashes(
+        (len, "x"), "hash_a", cache_location, index
+    )
+    found = cache_module.check_functions_and_hashes(
+        (len, "y"), "hash_b", cache_location, index
+    )
+
+    assert len(calls) == 1
+    assert missing == (
+        cache_module.save_to_cache,
+        "hash_a",
+        (len, "x"),
+        cache_location,
+    )
+    assert found == (
+        cache_module.load_from_cache,
+        "hash_b.parquet",
+        cache_location,
+        False,
+    )
+
+
+def test_save_to_cache_updates_manifest(tmp_path):
+    pytest.importorskip("pyarrow")
+    (tmp_path / "old.parquet").touch()
+    cache_location = f"file://{tmp_path}"
+
+    data = pd.DataFrame({"x": [1, 2, 3]})
+    cache_module.save_to_cache("new", data, cache_location)
+
+    manifest = cache_module.read_cache_manifest(cache_location)
+    assert set(manifest) == {"old", "new"}
+    assert manifest["new"]["rows"] == 3
+    assert manifest["new"]["file"] == "new.arrow"
+    assert manifest["new"]["size"] == (tmp_path / "new.arrow").stat().st_size
+    assert manifest["old"]["rows"] is None
+    assert manifest["old"]["format"] == "parquet"
+
+    # lookups come from the manifest, not from the directory listing
+    (tmp_path / "unlisted.parquet").touch()
+    assert sorted(cache_module.get_cached_files(cache_location)) == ["new", "old"]
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_deleted_cache_files_are_recomputed(tmp_path):
+    cache_location = f"file://{tmp_path}"
+    for name in ("kept", "deleted"):
+        cache_module.save_to_cache(name, {"x": 1}, cache_location)
+    cache_module.save_to_cache("kept", {"x": 2}, cache_location)
+    (tmp_path / "deleted.pkl").unlink()
+
+    index = cache_module.CacheIndex(cache_location)
+    assert "kept" in index
+    assert "deleted" not in index
+    task = cache_module.check_functions_and_hashes(
+        (len, "x"), "deleted", cache_location, index
+    )
+    assert task[0] is cache_module.save_to_cache
+
+    assert cache_module.compact_cache_manifest(cache_location) == 1
+    manifest = cache_module.read_cache_manifest(cache_location)
+    assert list(manifest) == ["kept"]
+    assert len((tmp_path / "manifest.jsonl").read_text().splitlines()) == 1
+
+
+def test_generate_hash_from_value_is_content_aware():
+    def scale(data, factor):
+        return data * factor
+
+    first, _ = cache_module.generate_hash_from_value((partial(scale, factor=2), "x"))
+    second, _ = cache_module.generate_hash_from_value((partial(scale, factor=3), "x"))
+    again, _ = cache_module.generate_hash_from_value((partial(scale, factor=2), "x"))
+    assert first != second
+    assert first == again
+
+    # same repr, different content
+    small = pd.DataFrame({"x": range(100)})
+    other = small.copy()
+    other.loc[50, "x"] = -1
+    assert repr(small) == repr(other)
+    assert (
+        cache_module.generate_hash_from_value((len, small))[0]
+        != cache_module.generate_hash_from_value((len, other))[0]
+    )
+
+
+def test_normalize_for_hash_file_meta():
+    class FileMeta:
+        def __init__(self, file, entry_start=0, entry_stop=None):
+            self.file = file
+            self.entry_start = entry_start
+            self.entry_stop = entry_stop
+
+        def __call__(self):
+            return self.file
+
+    assert cache_module.hash_token(FileMeta("a.root")) == cache_module.hash_token(
+        FileMeta("a.root")
+    )
+    assert cache_module.hash_token(FileMeta("a.root")) != cache_module.hash_token(
+        FileMeta("b.root")
+    )
+    assert cache_module.hash_token(
+        FileMeta("a.root", 0, 100)
+    ) != cache_module.hash_token(FileMeta("a.root", 100, 200))
+
+
+def test_hash_graph_merkle():
+    graph = {
+        "a": (sum, [1, 2]),
+        "b": (len, "a"),
+        "c": (max, "a", "b"),
+        "alias": "c",
+    }
+    hashes, hash_tuples = cache_module.hash_graph(graph)
+
+    assert set(hash_tuples) == {"a", "b", "c"}
+    assert hashes["alias"] == hashes["c"]
+
+    # changing an upstream task changes every hash downstream of it
+    changed, _ = cache_module.hash_graph(dict(graph, a=(sum, [1, 3])))
+    assert all(changed[key] != hashes[key] for key in graph)
+
+    # hashes do not depend on key names, only on content
+    renamed = {
+        "x": (sum, [1, 2]),
+        "y": (len, "x"),
+    }
+    renamed_hashes, _ = cache_module.hash_graph(renamed)
+    assert renamed_hashes["y"] == hashes["b"]
+
+
+@pytest.mark.parametrize("hash_uncached_by_name", [False, True])
+def test_graph_to_futures_keeps_uncached_layers(
+    tmp_path, monkeypatch, hash_uncached_by_name
+):
+    da = pytest.importorskip("dask.array")
+    from dask.highlevelgraph import MaterializedLayer
+    from distributed import Client
+
+    submitted = []
+    monkeypatch.setattr(
+        Client,
+        "_graph_to_futures",
+        lambda self, dsk, *args, **kwargs: submitted.append(dsk),
+    )
+    client = object.__new__(cache_module.DiracClient)
+    client.cache_location = f"file://{tmp_path}"
+    client.cache_layers = {"sum", "sum-aggregate"}
+    client.memory_map_loads = False
+    client.dirac_settings = None
+    client.hash_uncached_by_name = hash_uncached_by_name
+
+    array = (da.ones(10, chunks=5) + 1).sum()
+    graph = array.__dask_graph__()
+    client._graph_to_futures(graph, list(array.__dask_keys__()))
+
+    (result,) = submitted
+    assert result.dependencies == graph.dependencies
+    for name, layer in result.layers.items():
+        if name.startswith("sum") and hash_uncached_by_name:
+            assert isinstance(layer, MaterializedLayer)
+            assert all(task[0] is cache_module.save_to_cache for task in layer.values())
+        elif name.startswith("sum"):
+            # the inputs of the sums are only known by their key names
+            assert not any(
+                task[0] is cache_module.save_to_cache for task in layer.values()
+            )
+        else:
+            assert layer is graph.layers[name]
+
+
+def test_cache_writer_write_behind(tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    cache_location = f"file://{tmp_path}"
+    writer = cache_module.CacheWriter(max_pending=2)
+    writer.setup(worker=None)
+    monkeypatch.setattr(cache_module, "_get_cache_writer", lambda: writer)
+
+    data = pd.DataFrame({"x": [1, 2, 3]})
+    for name in ("a", "b", "c"):
+        assert cache_module.save_to_cache(name, data, cache_location) is data
+
+    writer.teardown(worker=None)
+    assert sorted(cache_module.get_cached_files(cache_location)) == ["a", "b", "c"]
+
+
+@pytest.mark.parametrize(
+    ("data", "extension"),
+    [
+        (pd.DataFrame({0: [1, 2], 1: ["x", "y"]}, index=[5, 6]), ".arrow"),
+        # mixed column name types are not supported by arrow
+        (pd.DataFrame({0: [1, 2], "b": ["x", "y"]}), ".pkl"),
+        (np.arange(12, dtype="int32").reshape(3, 4), ".npy"),
+        (np.array([{"a": 1}, None], dtype=object), ".pkl"),
+        (pd.Series([1.0, 2.0], name="s"), ".pkl"),
+        ({"histogram": [1, 2, 3]}, ".pkl"),
+    ],
+)
+def test_cache_round_trip(tmp_path, data, extension):
+    pytest.importorskip("pyarrow")
+    cache_location = f"file://{tmp_path}"
+
+    cache_module.save_to_cache("entry", data, cache_location)
+    index = cache_module.CacheIndex(cache_location)
+    assert index.file_name("entry") == "entry" + extension
+
+    loaded = cache_module.load_from_cache(index.file_name("entry"), cache_location)
+    assert type(loaded) is type(data)
+    if isinstance(data, np.ndarray):
+        assert loaded.dtype == data.dtype
+        assert np.array_equal(loaded, data)
+    elif isinstance(data, (pd.DataFrame, pd.Series)):
+        assert loaded.equals(data)
+    else:
+        assert loaded == data
+
+
+def test_load_from_cache_memory_mapped(tmp_path):
+    pytest.importorskip("pyarrow")
+    cache_location = f"file://{tmp_path}"
+    frame = pd.DataFrame({"x": np.arange(1000.0), "y": np.arange(1000)})
+    array = np.arange(1000.0).reshape(10, 100)
+    cache_module.save_to_cache("frame", frame, cache_location)
+    cache_module.save_to_cache("array", array, cache_location)
+
+    loaded_frame = cache_module.load_from_cache(
+        "frame.arrow", cache_location, memory_map=True
+    )
+    loaded_array = cache_module.load_from_cache(
+        "array.npy", cache_location, memory_map=True
+    )
+
+    assert loaded_frame.equals(frame)
+    assert not loaded_frame["x"].to_numpy().flags.writeable
+    assert type(loaded_array) is np.ndarray
+    assert np.array_equal(loaded_array, array)
+    assert not loaded_array.flags.writeable
+
+
+def test_cache_round_trip_awkward(tmp_path):
+    ak = pytest.importorskip("awkward")
+    pytest.importorskip("pyarrow")
+    cache_location = f"file://{tmp_path}"
+    data = ak.Array([[1, 2], [], [3]])
+
+    cache_module.save_to_cache("entry", data, cache_location)
+    loaded = cache_module.load_from_cache("entry.ak.parquet", cache_location)
+    assert loaded.tolist() == data.tolist()
+
+
+def test_dirac_cache_round_trip(tmp_path, monkeypatch):
+    storage = tmp_path / "storage"
+    monkeypatch.setattr(cache_module.tempfile, "gettempdir", lambda: str(tmp_path))
+
+    def add_file(settings, local_file, remote_file, overwrite):
+        target = storage / remote_file.lstrip("/")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_bytes(Path(local_file).read_bytes())
+        return {"OK": True}
+
+    def download_file(settings, remote_file, local_file):
+        Path(local_file).write_bytes((storage / remote_file.lstrip("/")).read_bytes())
+
+    monkeypatch.setattr(cache_module._dirac, "add_file", add_file)
+    monkeypatch.setattr(cache_module._dirac, "download_file", download_file)
+
+    cache_location = "dirac:///cache/dir"
+    server_url = "https://dirac.example.org"
+    cache_module.save_to_cache("entry", {"x": 1}, cache_location, server_url)
+    shard = cache_module._dirac_cache_shard("entry.pkl")
+    assert (storage / f"cache/dir/{shard}/entry.pkl").exists()
+
+    # a fresh node has to download the file
+    staging_dir = cache_module._dirac_staging_dir("/cache/dir")
+    os.remove(f"{staging_dir}/entry.pkl")
+    loaded = cache_module.load_from_cache(
+        f"{shard}/entry.pkl", cache_location, False, server_url
+    )
+    assert loaded == {"x": 1}
+    assert os.path.exists(f"{staging_dir}/entry.pkl")
+
+
+def test_dirac_cache_write_errors_do_not_fail_tasks(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(cache_module.tempfile, "gettempdir", lambda: str(tmp_path))
+
+    def add_file(settings, local_file, remote_file, overwrite):
+        raise RuntimeError("file exists")
+
+    monkeypatch.setattr(cache_module._dirac, "add_file", add_file)
+    server_url = "https://dirac.example.org"
+
+    data = {"x": 1}
+    assert cache_module.save_to_cache("entry", data, "dirac:///dir", server_url) is data
+    assert "Failed to write cache entry entry" in caplog.text
+
+
+def test_dirac_cache_listing_is_batched(monkeypatch):
+    requests = []
+
+    def get_directory_dump(settings, lfns):
+        requests.append(lfns)
+        return {
+            "OK": True,
+            "Value": {
+                "Successful": {
+                    "/cache/dir": {"Files": {"/cache/dir/old.pkl": {}}},
+                    "/cache/dir/0a": {"Files": {"/cache/dir/0a/new.npy": {}}},
+                }
+            },
+        }
+
+    monkeypatch.setattr(cache_module._dirac, "get_directory_dump", get_directory_dump)
+    settings = cache_module._dirac.DiracSettings("https://dirac.example.org")
+
+    entries = cache_module.get_cache_entries("dirac:///cache/dir/", settings)
+
+    assert len(requests) == 1
+    assert len(requests[0]) == 1 + cache_module.DIRAC_CACHE_SHARDS
+    assert entries == {"old": "old.pkl", "new": "0a/new.npy"}
+
+
+def test_staging_dir_is_pruned(tmp_path):
+    for age, name in enumerate(["new", "middle", "old"]):
+        path = tmp_path / f"{name}.pkl"
+        path.write_bytes(b"x" * 100)
+        os.utime(path, (1000 - age, 1000 - age))
+
+    with dask.config.set({"dirac.staging-limit": "250B"}):
+        cache_module._prune_staging_dir(str(tmp_path), keep=str(tmp_path / "old.pkl"))
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["new.pkl", "old.pkl"]
+
+
+def test_dirac_settings_are_passed_to_cache_tasks(monkeypatch):
+    listed_with = []
+
+    def get_directory_dump(settings, lfns):
+        listed_with.append(settings)
+        return {"OK": True, "Value": {"Successful": {}}}
+
+    monkeypatch.setattr(cache_module._dirac, "get_directory_dump", get_directory_dump)
+    settings = cache_module._dirac.DiracSettings("https://dirac.example.org")
+
+    index = cache_module.CacheIndex("dirac:///cache/dir", settings)
+    task = cache_module.check_functions_and_hashes(
+        (len, "x"), "hash_a", "dirac:///cache/dir", index
+    )
+
+    assert listed_with == [settings]
+    assert task[0] is cache_module.save_to_cache
+    # the client's proxy and CA paths do not exist on the workers
+    assert task[-1] == settings.server_url
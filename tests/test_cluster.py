@@ -0,0 +1,784 @@
+from __future__ import annotations
+
+import asyncio
+import gc
+import json
+import weakref
+
+import pytest
+
+import dask_dirac._dask as dask_module
+
+
+def test_parametric_batcher():
+    submitted = []
+
+    async def submit(n_jobs):
+        start = sum(submitted)
+        submitted.append(n_jobs)
+        return [str(start + i) for i in range(n_jobs)]
+
+    async def main():
+        batcher = dask_module.ParametricBatcher(submit, max_batch_size=2, delay=0)
+        return await asyncio.gather(*(batcher.job_id() for _ in range(5)))
+
+    job_ids = asyncio.run(main())
+
+    assert sorted(submitted) == [1, 2, 2]
+    assert sorted(job_ids, key=int) == [str(i) for i in range(5)]
+
+
+def test_parametric_batcher_failure():
+    async def submit(n_jobs):
+        raise RuntimeError("server down")
+
+    async def main():
+        batcher = dask_module.ParametricBatcher(submit, max_batch_size=10, delay=0)
+        return await asyncio.gather(
+            *(batcher.job_id() for _ in range(3)), return_exceptions=True
+        )
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_dirac_job_batchers_are_per_cluster():
+    settings = dask_module._dirac.DiracSettings("https://dirac.example.org")
+    clients = [dask_module.AsyncDiracClient(settings) for _ in range(2)]
+
+    def make_job(client, **kwargs):
+        return dask_module.DiracJob(
+            "tcp://127.0.0.1:8786",
+            scheduler_address="127.0.0.1",
+            cores=1,
+            memory="1GB",
+            dirac_client=client,
+            **kwargs,
+        )
+
+    first, second = (make_job(client) for client in clients)
+    assert first._batcher() is not second._batcher()
+    assert make_job(clients[0])._batcher() is first._batcher()
+    assert make_job(clients[0], max_parametric_jobs=5)._batcher() is not (
+        first._batcher()
+    )
+    assert make_job(clients[0], in_process_submission=False)._batcher() is not (
+        first._batcher()
+    )
+
+    # the batcher does not keep the job that made it alive
+    batcher = first._batcher()
+    job_ref = weakref.ref(first)
+    del first
+    gc.collect()
+    assert job_ref() is None
+    assert make_job(clients[0])._batcher() is batcher
+
+
+def test_job_ids_from_submit_output():
+    out = "{'OK': True, 'Value': [101, 102], 'JobID': [101, 102]}\n"
+    assert dask_module._job_ids_from_submit_output(out) == ["101", "102"]
+    assert dask_module._job_ids_from_submit_output("{'OK': True, 'Value': 7}") == ["7"]
+    with pytest.raises(RuntimeError, match="no proxy"):
+        dask_module._job_ids_from_submit_output("{'OK': False, 'Message': 'no proxy'}")
+
+
+def test_dirac_job_submits_in_process(monkeypatch):
+    submitted = []
+
+    def submit_job(settings, jdl):
+        submitted.append((settings.server_url, jdl))
+        return {"OK": True, "Value": [11, 12]}
+
+    monkeypatch.setattr(dask_module._dirac, "submit_job", submit_job)
+    job = dask_module.DiracJob(
+        "tcp://127.0.0.1:8786",
+        submission_url="https://dirac.example.org",
+        scheduler_address="127.0.0.1",
+        cores=1,
+        memory="1GB",
+    )
+
+    assert asyncio.run(job._submit_parametric(2)) == ["11", "12"]
+    ((server_url, jdl),) = submitted
+    assert server_url == "https://dirac.example.org"
+    assert "Parameters = 2;" in jdl
+
+
+def test_public_address_cache(monkeypatch):
+    lookups = []
+
+    class Response:
+        content = b"192.0.2.1\n"
+
+    def get(url, timeout):
+        lookups.append(url)
+        return Response()
+
+    monkeypatch.setattr(dask_module, "get", get)
+    cache = dask_module.PublicAddressCache(url="https://ip.example.org", ttl=60)
+
+    async def main():
+        return await asyncio.gather(*(cache.get() for _ in range(5)))
+
+    assert asyncio.run(main()) == ["192.0.2.1"] * 5
+    assert asyncio.run(main()) == ["192.0.2.1"] * 5
+    assert lookups == ["https://ip.example.org"]
+
+    cache.ttl = 0
+    asyncio.run(cache.get())
+    assert len(lookups) == 2
+
+
+def test_dirac_job_scheduler_address(monkeypatch):
+    def get(*args, **kwargs):
+        raise AssertionError("the public address should not be looked up")
+
+    monkeypatch.setattr(dask_module, "get", get)
+    submitted = []
+
+    def submit_job(settings, jdl):
+        submitted.append(jdl)
+        return {"OK": True, "Value": 5}
+
+    monkeypatch.setattr(dask_module._dirac, "submit_job", submit_job)
+
+    job = dask_module.DiracJob(
+        "tcp://127.0.0.1:8786",
+        scheduler_address="scheduler.example.org",
+        cores=1,
+        memory="1GB",
+    )
+
+    assert asyncio.run(job._submit_parametric(1)) == ["5"]
+    assert "tcp://scheduler.example.org:8786" in submitted[0]
+    assert "Parameters" not in submitted[0]
+
+
+def test_dirac_job_jdl_file_is_deprecated():
+    with pytest.warns(DeprecationWarning, match="jdl_file"):
+        job = dask_module.DiracJob(
+            "tcp://127.0.0.1:8786",
+            jdl_file="/tmp/job.jdl",
+            scheduler_address="127.0.0.1",
+            cores=1,
+            memory="1GB",
+        )
+    assert "jdl_file" not in job._jdl_kwargs
+
+
+def test_dirac_jobs_share_rendered_jdl():
+    jobs = [
+        dask_module.DiracJob(
+            "tcp://127.0.0.1:8786",
+            scheduler_address="127.0.0.1",
+            dirac_sites=["site_a", "site_b"],
+            cores=1,
+            memory="1GB",
+        )
+        for _ in range(2)
+    ]
+    jdl_kwargs = [tuple(job._jdl_kwargs.items()) for job in jobs]
+    assert jdl_kwargs[0] == jdl_kwargs[1]
+
+    dask_module._render_jdl.cache_clear()
+    jdls = [dask_module._render_jdl("127.0.0.1", None, kwargs) for kwargs in jdl_kwargs]
+
+    assert jdls[0] is jdls[1]
+    assert 'Site = "site_a, site_b"' in jdls[0]
+    assert dask_module._render_jdl.cache_info().hits == 1
+
+
+def test_dirac_cluster_replaces_ended_jobs(monkeypatch):
+    job_ids = iter(range(1, 100))
+    status = {}
+
+    def submit_job(settings, jdl):
+        return {"OK": True, "Value": next(job_ids)}
+
+    def get_jobs_status(settings, ids):
+        return {
+            "OK": True,
+            "Value": {str(i): {"Status": status.get(str(i), "Waiting")} for i in ids},
+        }
+
+    monkeypatch.setattr(dask_module._dirac, "submit_job", submit_job)
+    monkeypatch.setattr(dask_module._dirac, "get_jobs_status", get_jobs_status)
+    cancelled = []
+
+    def cancel_jobs(method):
+        def cancel(settings, ids):
+            cancelled.append((method, sorted(ids)))
+            return {"OK": True, "Value": ids}
+
+        return cancel
+
+    monkeypatch.setattr(dask_module._dirac, "kill_jobs", cancel_jobs("kill"))
+    monkeypatch.setattr(dask_module._dirac, "delete_jobs", cancel_jobs("delete"))
+
+    async def main():
+        async with dask_module.DiracCluster(
+            asynchronous=True,
+            scheduler_address="127.0.0.1",
+            batch_submissions=False,
+            status_interval=0.05,
+            scheduler_options={"dashboard_address": ":0"},
+        ) as cluster:
+            cluster.scale(2)
+            await cluster
+            while len(cluster.job_status) < 2:
+                await asyncio.sleep(0.05)
+            assert set(cluster.job_status.values()) == {"Waiting"}
+            # one client for the queries of the cluster and all of its jobs
+            assert all(
+                job._client() is cluster._dirac_client
+                for job in cluster.workers.values()
+            )
+
+            failed_name = next(
+                name for name, job in cluster.workers.items() if job.job_id == "1"
+            )
+            status["1"] = "Failed"
+            while failed_name in cluster.workers:
+                await asyncio.sleep(0.05)
+            await cluster
+            assert len(cluster.worker_spec) == 2
+            assert {job.job_id for job in cluster.workers.values()} == {"2", "3"}
+            # the failed job has ended, it is not cancelled
+            assert cancelled == []
+
+    asyncio.run(asyncio.wait_for(main(), 30))
+    # closing the cluster cancels the remaining jobs in bulk
+    assert cancelled == [("kill", ["2", "3"]), ("delete", ["2", "3"])]
+
+
+def test_dirac_cluster_replaces_jobs_queued_too_long(monkeypatch):
+    job_ids = iter(range(1, 100))
+    cancelled = []
+
+    def submit_job(settings, jdl):
+        return {"OK": True, "Value": next(job_ids)}
+
+    def get_jobs_status(settings, ids):
+        # only the first job is stuck in the queue
+        return {
+            "OK": True,
+            "Value": {i: {"Status": "Waiting" if i == "1" else "Running"} for i in ids},
+        }
+
+    def kill_jobs(settings, ids):
+        cancelled.extend(ids)
+        return {"OK": True, "Value": ids}
+
+    monkeypatch.setattr(dask_module._dirac, "submit_job", submit_job)
+    monkeypatch.setattr(dask_module._dirac, "get_jobs_status", get_jobs_status)
+    monkeypatch.setattr(dask_module._dirac, "kill_jobs", kill_jobs)
+    monkeypatch.setattr(
+        dask_module._dirac, "delete_jobs", lambda settings, ids: {"OK": True}
+    )
+
+    async def main():
+        async with dask_module.DiracCluster(
+            asynchronous=True,
+            scheduler_address="127.0.0.1",
+            batch_submissions=False,
+            status_interval=0.05,
+            queue_timeout=0.2,
+            scheduler_options={"dashboard_address": ":0"},
+        ) as cluster:
+            cluster.scale(1)
+            await cluster
+            while not cancelled:
+                await asyncio.sleep(0.05)
+            await cluster
+            assert cancelled == ["1"]
+            assert [job.job_id for job in cluster.workers.values()] == ["2"]
+
+    asyncio.run(asyncio.wait_for(main(), 30))
+
+
+def test_site_statistics(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(dask_module.time, "monotonic", lambda: now[0])
+    statistics = dask_module.SiteStatistics()
+
+    # nothing known yet: split evenly
+    assert statistics.allocate(4, ["fast", "slow"]) == {"fast": 2, "slow": 2}
+
+    statistics.submitted("1", "fast")
+    statistics.submitted("2", "slow")
+    now[0] = 10.0
+    statistics.observe({"1": "Running", "2": "Waiting"})
+    now[0] = 40.0
+    statistics.observe({"1": "Running", "2": "Waiting"})
+
+    assert statistics.latency("fast") == 10.0
+    assert statistics.latency("slow") == 40.0
+    assert statistics.latency("new") is None
+    assert statistics.allocate(10, ["fast", "slow"]) == {"fast": 8, "slow": 2}
+    # untried sites are given a chance
+    assert statistics.allocate(2, ["fast", "new"]) == {"fast": 1, "new": 1}
+
+    statistics.observe({"2": "Failed"})
+    assert statistics.latency("slow") is None
+
+    # jobs given up on count against their site with the time they waited
+    statistics.submitted("4", "fast")
+    now[0] = 70.0
+    statistics.timed_out("4")
+    assert statistics.latency("fast") == 20.0
+
+    # jobs closed before they started do not count against their site
+    statistics.submitted("3", "slow")
+    statistics.forget("3")
+    now[0] = 1000.0
+    assert statistics.latency("slow") is None
+
+
+def test_site_statistics_rotates_ties():
+    statistics = dask_module.SiteStatistics()
+    sites = ["a", "b", "c"]
+    allocations = [statistics.allocate(1, sites) for _ in range(3)]
+    assert allocations == [{"a": 1}, {"b": 1}, {"c": 1}]
+
+
+def test_dirac_job_splits_submissions_between_sites(monkeypatch):
+    job_ids = iter(range(1, 100))
+    submitted = []
+
+    def submit_job(settings, jdl):
+        n_jobs = (
+            int(jdl.split("Parameters = ")[1].split(";")[0]) if "Param" in jdl else 1
+        )
+        site = jdl.split('Site = "')[1].split('"')[0]
+        submitted.append((site, n_jobs))
+        return {"OK": True, "Value": [next(job_ids) for _ in range(n_jobs)]}
+
+    monkeypatch.setattr(dask_module._dirac, "submit_job", submit_job)
+    statistics = dask_module.SiteStatistics()
+    statistics.latencies = {"fast": [10.0], "slow": [30.0]}
+    job = dask_module.DiracJob(
+        "tcp://127.0.0.1:8786",
+        scheduler_address="127.0.0.1",
+        dirac_sites=["fast", "slow"],
+        site_statistics=statistics,
+        cores=1,
+        memory="1GB",
+    )
+
+    assert len(asyncio.run(job._submit_parametric(4))) == 4
+    assert sorted(submitted) == [("fast", 3), ("slow", 1)]
+
+
+def test_dirac_job_cancels_submissions_of_a_failed_batch(monkeypatch):
+    cancelled = []
+
+    def submit_job(settings, jdl):
+        if 'Site = "down"' in jdl:
+            return {"OK": False, "Message": "site is down"}
+        return {"OK": True, "Value": [1, 2]}
+
+    def kill_jobs(settings, ids):
+        cancelled.extend(ids)
+        return {"OK": True, "Value": ids}
+
+    monkeypatch.setattr(dask_module._dirac, "submit_job", submit_job)
+    monkeypatch.setattr(dask_module._dirac, "kill_jobs", kill_jobs)
+    monkeypatch.setattr(
+        dask_module._dirac, "delete_jobs", lambda settings, ids: {"OK": True}
+    )
+    statistics = dask_module.SiteStatistics()
+    job = dask_module.DiracJob(
+        "tcp://127.0.0.1:8786",
+        scheduler_address="127.0.0.1",
+        dirac_sites=["up", "down"],
+        site_statistics=statistics,
+        cores=1,
+        memory="1GB",
+    )
+
+    with pytest.raises(RuntimeError, match="site is down"):
+        asyncio.run(job._submit_parametric(4))
+    assert cancelled == ["1", "2"]
+    assert statistics.latency("up") is None
+
+
+def test_dirac_job_site_ports_follow_the_submission_site(monkeypatch):
+    jdls = {}
+
+    def submit_job(settings, jdl):
+        site = jdl.split('Site = "')[1].split('"')[0]
+        jdls[site] = jdl
+        return {"OK": True, "Value": [len(jdls)]}
+
+    monkeypatch.setattr(dask_module._dirac, "submit_job", submit_job)
+    statistics = dask_module.SiteStatistics()
+    ralpp = "LCG.UKI-SOUTHGRID-RALPP.uk"
+    job = dask_module.DiracJob(
+        "tcp://127.0.0.1:8786",
+        scheduler_address="127.0.0.1",
+        dirac_sites=[ralpp, "other"],
+        site_statistics=statistics,
+        cores=1,
+        memory="1GB",
+    )
+
+    job_ids = asyncio.run(job._submit_parametric(2))
+    assert "--worker-port 50000:52000" in jdls[ralpp]
+    assert "--worker-port" not in jdls["other"]
+
+    # closing a job that has not started forgets it
+    monkeypatch.setattr(dask_module._dirac, "kill_jobs", lambda *_: {"OK": True})
+    monkeypatch.setattr(dask_module._dirac, "delete_jobs", lambda *_: {"OK": True})
+    job.job_id = job_ids[0]
+    asyncio.run(job.close())
+    assert set(statistics._waiting) == set(job_ids[1:])
+
+
+def test_dirac_cluster_overprovisioning(monkeypatch):
+    job_ids = iter(range(1, 100))
+    cancelled = []
+
+    monkeypatch.setattr(
+        dask_module._dirac,
+        "submit_job",
+        lambda settings, jdl: {"OK": True, "Value": next(job_ids)},
+    )
+    monkeypatch.setattr(
+        dask_module._dirac,
+        "get_jobs_status",
+        lambda settings, ids: {
+            "OK": True,
+            "Value": {
+                str(i): {"Status": "Running" if int(i) <= 2 else "Waiting"} for i in ids
+            },
+        },
+    )
+
+    def kill_jobs(settings, ids):
+        cancelled.append(sorted(ids))
+        return {"OK": True, "Value": ids}
+
+    monkeypatch.setattr(dask_module._dirac, "kill_jobs", kill_jobs)
+    monkeypatch.setattr(
+        dask_module._dirac, "delete_jobs", lambda settings, ids: {"OK": True}
+    )
+
+    async def main():
+        async with dask_module.DiracCluster(
+            asynchronous=True,
+            scheduler_address="127.0.0.1",
+            batch_submissions=False,
+            overprovision_factor=2,
+            scheduler_options={"dashboard_address": ":0"},
+        ) as cluster:
+            cluster.scale(jobs=2)
+            await cluster
+            assert len(cluster.workers) == 4
+            # asking for the pending target again, e.g. by adapt, is a no-op
+            cluster.scale(jobs=2)
+            await cluster
+            assert len(cluster.workers) == 4
+            assert cancelled == []
+
+            # two workers connect to the scheduler
+            cluster._update_worker_status(
+                "add",
+                {"workers": {"tcp://a:1": {"name": "a"}, "tcp://b:1": {"name": "b"}}},
+            )
+            await asyncio.gather(*cluster._futures)
+
+            assert cluster.time_to_target is not None
+            assert cancelled == [["3", "4"]]
+            assert {job.job_id for job in cluster.workers.values()} == {"1", "2"}
+
+            # only the increase is overprovisioned
+            cluster.scale(jobs=3)
+            await cluster
+            assert len(cluster.workers) == 4
+            cluster.scheduler_info["workers"].clear()
+
+    asyncio.run(asyncio.wait_for(main(), 30))
+
+
+def test_dirac_job_multicore_pilot():
+    job = dask_module.DiracJob(
+        "tcp://127.0.0.1:8786",
+        scheduler_address="127.0.0.1",
+        cores=8,
+        processes=4,
+        memory="16GiB",
+    )
+    jdl = dask_module._render_jdl("127.0.0.1", None, tuple(job._jdl_kwargs.items()))
+
+    assert "--nworkers 4 --memory-limit 4.00GiB --nthreads 2" in jdl
+    assert "NumberOfProcessors = 8;" in jdl
+    assert "MaxRAM = 16384;" in jdl
+    assert "WholeNode" not in jdl
+
+    single = dask_module.DiracJob(
+        "tcp://127.0.0.1:8786", scheduler_address="127.0.0.1", cores=1, memory="1GB"
+    )
+    jdl = dask_module._render_jdl("127.0.0.1", None, tuple(single._jdl_kwargs.items()))
+    assert "--nworkers" not in jdl
+    assert "NumberOfProcessors" not in jdl
+
+
+def test_dirac_job_multicore_pilot_without_memory():
+    job = dask_module.DiracJob(
+        "tcp://127.0.0.1:8786", scheduler_address="127.0.0.1", cores=8
+    )
+    jdl = dask_module._render_jdl("127.0.0.1", None, tuple(job._jdl_kwargs.items()))
+
+    assert "--nworkers 4 --nthreads 2" in jdl
+    assert "--memory-limit" not in jdl
+    assert "NumberOfProcessors = 8;" in jdl
+    assert "MaxRAM" not in jdl
+
+    whole_node = dask_module.DiracJob(
+        "tcp://127.0.0.1:8786",
+        scheduler_address="127.0.0.1",
+        cores=1,
+        whole_node=True,
+    )
+    jdl = dask_module._render_jdl(
+        "127.0.0.1", None, tuple(whole_node._jdl_kwargs.items())
+    )
+    assert "--nworkers auto" in jdl
+    assert "--nthreads" not in jdl
+    assert "--memory-limit" not in jdl
+    assert "NumberOfProcessors" not in jdl
+    assert 'WholeNode = "yes";' in jdl
+
+
+def test_dirac_cluster_rendezvous(monkeypatch):
+    published = []
+    cancelled = []
+    submitted = []
+
+    def add_file(settings, local_file, remote_file, overwrite):
+        with open(local_file, encoding="utf-8") as file_handle:
+            published.append((remote_file, json.load(file_handle)))
+        return {"OK": True}
+
+    def submit_job(settings, jdl):
+        submitted.append(jdl)
+        return {"OK": True, "Value": len(submitted)}
+
+    monkeypatch.setattr(dask_module._dirac, "add_file", add_file)
+    monkeypatch.setattr(dask_module._dirac, "submit_job", submit_job)
+    monkeypatch.setattr(
+        dask_module._dirac,
+        "kill_jobs",
+        lambda settings, ids: cancelled.append(ids) or {"OK": True},
+    )
+
+    async def main():
+        async with dask_module.DiracCluster.from_name(
+            "/user/rdv.json",
+            asynchronous=True,
+            scheduler_address="scheduler.example.org",
+            batch_submissions=False,
+            scheduler_options={"dashboard_address": ":0"},
+        ) as cluster:
+            # published before any job is submitted
+            ((lfn, rendezvous),) = published
+            port = cluster.scheduler_address.rsplit(":", 1)[1]
+            assert lfn == "/user/rdv.json"
+            assert rendezvous["address"] == f"tcp://scheduler.example.org:{port}"
+            assert rendezvous["name"] == cluster.name
+            cluster.scale(1)
+            await cluster
+
+    asyncio.run(asyncio.wait_for(main(), 30))
+
+    (jdl,) = submitted
+    assert "dask-dirac pilot https://" in jdl
+    assert "/user/rdv.json --idle-timeout 1800" in jdl
+    assert "dask worker tcp" not in jdl
+    # the pilots are left running for the next cluster
+    assert cancelled == []
+
+
+def test_dirac_cluster_ships_worker_credentials(monkeypatch):
+    from distributed.security import Security
+
+    uploaded = {}
+    modes = {}
+    removed = []
+
+    def add_file(settings, local_file, remote_file, overwrite):
+        with open(local_file, encoding="utf-8") as file_handle:
+            uploaded[remote_file] = file_handle.read()
+        return {"OK": True}
+
+    def change_path_mode(settings, lfn, mode):
+        modes[lfn] = mode
+        return {"OK": True}
+
+    def chmod_file(settings, lfn, mode):
+        raise OSError("Operation not supported")
+
+    monkeypatch.setattr(dask_module._dirac, "add_file", add_file)
+    monkeypatch.setattr(dask_module._dirac, "change_path_mode", change_path_mode)
+    monkeypatch.setattr(dask_module._dirac, "chmod_file", chmod_file)
+    monkeypatch.setattr(
+        dask_module._dirac,
+        "delete_file",
+        lambda settings, lfn: removed.append(lfn) or {"OK": True},
+    )
+    security = Security(
+        tls_ca_file="CA\n",
+        tls_worker_cert="CERT\n",
+        tls_worker_key="KEY\n",
+        require_encryption=True,
+    )
+
+    async def main():
+        cluster = dask_module.DiracCluster(
+            asynchronous=True,
+            security=security,
+            credentials_dir="/user/creds",
+            scheduler_address="scheduler.example.org",
+            allow_unrestricted_credentials=True,
+        )
+        lfns = cluster.worker_credentials
+        assert set(lfns) == {"dask-ca.pem", "dask-cert.pem", "dask-key.pem"}
+        assert all(lfn.startswith("/user/creds/") for lfn in lfns.values())
+
+        job = cluster._dummy_job
+        jdl = dask_module._render_jdl(
+            "scheduler.example.org", None, tuple(job._jdl_kwargs.items())
+        )
+        assert "dask worker tls://scheduler.example.org:8786" in jdl
+        assert "--protocol tls:// --tls-ca-file dask-ca.pem" in jdl
+        assert f'"LFN:{lfns["dask-key.pem"]}"' in jdl
+
+        await cluster._upload_credentials()
+        assert uploaded == {
+            lfns["dask-ca.pem"]: "CA\n",
+            lfns["dask-cert.pem"]: "CERT\n",
+            lfns["dask-key.pem"]: "KEY\n",
+        }
+        assert modes == dict.fromkeys(lfns.values(), 0o600)
+        await cluster.close()
+        assert sorted(removed) == sorted(lfns.values())
+
+    asyncio.run(asyncio.wait_for(main(), 30))
+
+
+def test_dirac_cluster_needs_restricted_worker_credentials(monkeypatch):
+    from distributed.security import Security
+
+    uploaded = []
+    removed = []
+
+    def chmod_file(settings, lfn, mode):
+        raise OSError("Operation not supported")
+
+    monkeypatch.setattr(
+        dask_module._dirac,
+        "add_file",
+        lambda settings, local_file, lfn, overwrite: uploaded.append(lfn)
+        or {"OK": True},
+    )
+    monkeypatch.setattr(
+        dask_module._dirac, "change_path_mode", lambda *args: {"OK": True}
+    )
+    monkeypatch.setattr(dask_module._dirac, "chmod_file", chmod_file)
+    monkeypatch.setattr(
+        dask_module._dirac,
+        "delete_file",
+        lambda settings, lfn: removed.append(lfn) or {"OK": True},
+    )
+
+    async def main():
+        cluster = dask_module.DiracCluster(
+            asynchronous=True,
+            security=Security(
+                tls_ca_file="CA\n", tls_worker_cert="CERT\n", tls_worker_key="KEY\n"
+            ),
+            credentials_dir="/user/creds",
+            scheduler_address="scheduler.example.org",
+        )
+        with pytest.raises(RuntimeError, match="Could not restrict the replica"):
+            await cluster._upload_credentials()
+        # the files that made it to the storage are not left there
+        assert sorted(removed) == sorted(uploaded)
+        assert len(uploaded) == 3
+        await cluster.close()
+
+    asyncio.run(asyncio.wait_for(main(), 30))
+
+
+def test_dirac_cluster_refuses_to_ship_the_scheduler_key():
+    from distributed.security import Security
+
+    with pytest.raises(ValueError, match="key of the scheduler"):
+        dask_module.DiracCluster(
+            security=Security(tls_scheduler_key="KEY\n", tls_worker_key="KEY\n"),
+            credentials_dir="/user/creds",
+        )
+
+
+def test_temporary_security_keeps_the_ca_key():
+    x509 = pytest.importorskip("cryptography.x509")
+
+    security = dask_module.temporary_security()
+    worker = security.get_tls_config_for_role("worker")
+    scheduler = security.get_tls_config_for_role("scheduler")
+
+    assert worker["key"] != scheduler["key"]
+    assert not dask_module._shares_scheduler_key(security)
+    ca_cert = x509.load_pem_x509_certificate(worker["ca_file"].encode())
+    for tls in (worker, scheduler):
+        cert = x509.load_pem_x509_certificate(tls["cert"].encode())
+        cert.verify_directly_issued_by(ca_cert)
+        assert cert != ca_cert
+
+
+def test_dirac_cluster_security_needs_credentials_dir():
+    from distributed.security import Security
+
+    with pytest.raises(ValueError, match="credentials_dir"):
+        dask_module.DiracCluster(security=Security(tls_ca_file="CA\n"))
+
+
+def test_dirac_job_container_images():
+    assert (
+        dask_module._unpacked_image("docker://sameriksen/dask:centos9")
+        == "/cvmfs/unpacked.cern.ch/registry.hub.docker.com/sameriksen/dask:centos9"
+    )
+    assert (
+        dask_module._unpacked_image("docker://python:3.11")
+        == "/cvmfs/unpacked.cern.ch/registry.hub.docker.com/library/python:3.11"
+    )
+    assert (
+        dask_module._unpacked_image("docker://ghcr.io/org/dask:1")
+        == "/cvmfs/unpacked.cern.ch/ghcr.io/org/dask:1"
+    )
+    assert dask_module._unpacked_image("/images/dask.sif") is None
+
+    job = dask_module.DiracJob(
+        "tcp://127.0.0.1:8786",
+        scheduler_address="127.0.0.1",
+        container_images=["/cvmfs/sw/dask", "$VO_SW_DIR/dask.sif"],
+        cores=1,
+        memory="1GB",
+    )
+    jdl = dask_module._render_jdl("127.0.0.1", None, tuple(job._jdl_kwargs.items()))
+    assert 'Executable = "/bin/sh";' in jdl
+    assert "image=docker://sameriksen/dask:centos9;" in jdl
+    assert "for candidate in /cvmfs/sw/dask $VO_SW_DIR/dask.sif;" in jdl
+    assert "$image dask worker tcp://127.0.0.1:8786" in jdl
+
+    job = dask_module.DiracJob(
+        "tcp://127.0.0.1:8786",
+        scheduler_address="127.0.0.1",
+        container="/images/dask.sif",
+        cores=1,
+        memory="1GB",
+    )
+    jdl = dask_module._render_jdl("127.0.0.1", None, tuple(job._jdl_kwargs.items()))
+    assert "for candidate" not in jdl
+    assert "image=/images/dask.sif;" in jdl
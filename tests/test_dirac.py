@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+
+from dask_dirac import _dirac
+from dask_dirac._dirac_async import AsyncDiracClient
+
+
+def test_settings_from_environment(monkeypatch):
+    monkeypatch.setenv("X509_USER_PROXY", "/path/to/proxy")
+    monkeypatch.setenv("X509_CERT_DIR", "/path/to/certificates")
+    monkeypatch.delenv("DIRAC_SERVER_URL", raising=False)
+
+    settings = _dirac.settings_from_environment()
+
+    assert settings.server_url == _dirac.DEFAULT_SERVER_URL
+    assert settings.user_proxy == "/path/to/proxy"
+    assert settings.capath == "/path/to/certificates"
+
+
+def test_http_client_pools_sessions(monkeypatch):
+    client = _dirac.DiracHTTPClient(pool_maxsize=4)
+    settings = _dirac.DiracSettings("https://dirac.example.org", user_proxy="/a")
+
+    session = client.session(settings)
+    assert client.session(_dirac.DiracSettings(**vars(settings))) is session
+    assert (
+        client.session(_dirac.DiracSettings(settings.server_url, user_proxy="/b"))
+        is not session
+    )
+    assert session.get_adapter("https://dirac.example.org")._pool_maxsize == 4
+
+    posted = []
+
+    class Response:
+        def json(self):
+            return {"OK": True}
+
+    def post(url, **kwargs):
+        posted.append((url, kwargs["data"]))
+        return Response()
+
+    monkeypatch.setattr(session, "post", post)
+    previous = _dirac.set_http_client(client)
+    try:
+        result = _dirac.get_jobs(settings)
+    finally:
+        _dirac.set_http_client(previous)
+        client.close()
+
+    assert result == {"OK": True}
+    assert posted[0][0] == "https://dirac.example.org/WorkloadManagement/JobMonitoring"
+
+
+def test_async_client_bounds_concurrency():
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def query(settings, value):
+        with lock:
+            running.append(value)
+            peak.append(len(running))
+        time.sleep(0.01)
+        settings.query_url = f"{settings.server_url}/{value}"
+        with lock:
+            running.remove(value)
+        return settings.query_url
+
+    settings = _dirac.DiracSettings("https://dirac.example.org")
+
+    async def main():
+        async with AsyncDiracClient(settings, max_concurrency=3) as client:
+            return await client.map(query, [(i,) for i in range(10)])
+
+    results = asyncio.run(main())
+
+    assert results == [f"https://dirac.example.org/{i}" for i in range(10)]
+    assert max(peak) == 3
+    assert settings.query_url == ""
+
+
+def test_async_client_close_does_not_wait():
+    release = threading.Event()
+    settings = _dirac.DiracSettings("https://dirac.example.org")
+
+    async def main():
+        client = AsyncDiracClient(settings, max_concurrency=1)
+        query = asyncio.ensure_future(client.call(lambda _: release.wait(5)))
+        await asyncio.sleep(0.05)
+        start = time.monotonic()
+        client.close()
+        closed_after = time.monotonic() - start
+        release.set()
+        await query
+        return closed_after
+
+    assert asyncio.run(main()) < 1
+
+
+class FakeGfal2Context:
+    def __init__(self, error=None):
+        self.error = error
+        self.unlinked = []
+
+    def unlink(self, url):
+        if self.error is not None:
+            raise self.error
+        self.unlinked.append(url)
+
+
+def test_delete_file_removes_replica_and_entry(monkeypatch):
+    context = FakeGfal2Context()
+    removed = []
+    monkeypatch.setattr(_dirac, "_gfal2_context", lambda settings: context)
+    monkeypatch.setattr(
+        _dirac, "remove_file", lambda settings, lfn: removed.append(lfn) or {"OK": True}
+    )
+    settings = _dirac.DiracSettings("https://dirac.example.org")
+
+    assert _dirac.delete_file(settings, "/user/key.pem") == {"OK": True}
+    assert context.unlinked == [f"{_dirac.STORAGE_BASE_URL}/user/key.pem"]
+    assert removed == ["/user/key.pem"]
+
+    # failures of the bulk method are failures
+    monkeypatch.setattr(
+        _dirac,
+        "remove_file",
+        lambda settings, lfn: {
+            "OK": True,
+            "Value": {"Successful": {}, "Failed": {lfn: "permission denied"}},
+        },
+    )
+    assert not _dirac.delete_file(settings, "/user/key.pem")["OK"]
+
+    # the catalog entry is kept while the replica is still there
+    context.error = OSError("permission denied")
+    result = _dirac.delete_file(settings, "/user/key.pem")
+    assert not result["OK"]
+    assert removed == ["/user/key.pem"]
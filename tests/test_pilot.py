@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+import dask_dirac._pilot as pilot_module
+
+
+def fake_storage(monkeypatch, storage):
+    def add_file(settings, local_file, remote_file, overwrite):
+        target = storage / remote_file.lstrip("/")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_bytes(Path(local_file).read_bytes())
+        return {"OK": True}
+
+    def download_file(settings, remote_file, local_file):
+        Path(local_file).write_bytes((storage / remote_file.lstrip("/")).read_bytes())
+
+    monkeypatch.setattr(pilot_module._dirac, "add_file", add_file)
+    monkeypatch.setattr(pilot_module._dirac, "download_file", download_file)
+
+
+def test_rendezvous_round_trip(tmp_path, monkeypatch):
+    fake_storage(monkeypatch, tmp_path)
+    settings = pilot_module._dirac.DiracSettings("https://dirac.example.org")
+
+    pilot_module.write_rendezvous(settings, "/user/rdv.json", "tcp://a:1", "c1")
+    rendezvous = pilot_module.read_rendezvous(settings, "/user/rdv.json")
+
+    assert rendezvous["address"] == "tcp://a:1"
+    assert rendezvous["name"] == "c1"
+
+
+def test_run_pilot_serves_each_scheduler_once(tmp_path, monkeypatch):
+    fake_storage(monkeypatch, tmp_path)
+    settings = pilot_module._dirac.DiracSettings("https://dirac.example.org")
+    now = [0.0]
+    monkeypatch.setattr(pilot_module.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(
+        pilot_module.time, "sleep", lambda seconds: now.__setitem__(0, now[0] + seconds)
+    )
+
+    schedulers = [("tcp://b:1", "c2"), ("tcp://a:1", "c1")]
+    served = []
+
+    def run_worker(address, worker_args, death_timeout):
+        served.append((address, list(worker_args)))
+        now[0] += 100
+        # the next cluster publishes its scheduler while these workers run
+        if schedulers:
+            pilot_module.write_rendezvous(settings, "/rdv.json", *schedulers.pop())
+        return 0
+
+    monkeypatch.setattr(pilot_module, "run_worker", run_worker)
+
+    # nothing published yet
+    pilot_module.run_pilot(settings, "/rdv.json", ["--nthreads", "2"], 60, 10)
+    assert served == []
+    assert now[0] >= 60
+
+    now[0] = 0.0
+    pilot_module.write_rendezvous(settings, "/rdv.json", "tcp://a:1", "c0")
+    pilot_module.run_pilot(settings, "/rdv.json", ["--nthreads", "2"], 60, 10)
+
+    assert served == [
+        ("tcp://a:1", ["--nthreads", "2"]),
+        # same address, but a new scheduler
+        ("tcp://a:1", ["--nthreads", "2"]),
+        ("tcp://b:1", ["--nthreads", "2"]),
+    ]
+    # stopped after waiting for a new scheduler for the idle timeout
+    assert now[0] == 300 + 60
+
+
+def test_run_pilot_downloads_credentials(tmp_path, monkeypatch):
+    fake_storage(monkeypatch, tmp_path / "storage")
+    monkeypatch.chdir(tmp_path)
+    settings = pilot_module._dirac.DiracSettings("https://dirac.example.org")
+    monkeypatch.setattr(pilot_module.time, "sleep", lambda seconds: None)
+    key_files = []
+
+    def run_worker(address, worker_args, death_timeout):
+        key_files.append(Path("dask-key.pem").read_text())
+        pilot_module.write_rendezvous(settings, "/rdv.json", "", "gone")
+        return 0
+
+    monkeypatch.setattr(pilot_module, "run_worker", run_worker)
+    pilot_module.upload_text(settings, "/creds/dask-key.pem", "KEY\n")
+    pilot_module.write_rendezvous(
+        settings,
+        "/rdv.json",
+        "tls://a:1",
+        "c1",
+        {"dask-key.pem": "/creds/dask-key.pem"},
+    )
+    pilot_module.run_pilot(settings, "/rdv.json", idle_timeout=0.01, poll_interval=0)
+
+    assert key_files == ["KEY\n"]
+
+
+def test_upload_text_checks_the_result(monkeypatch):
+    monkeypatch.setattr(
+        pilot_module._dirac,
+        "add_file",
+        lambda *args: {"OK": False, "Message": "no space left"},
+    )
+    settings = pilot_module._dirac.DiracSettings("https://dirac.example.org")
+
+    with pytest.raises(RuntimeError, match="no space left"):
+        pilot_module.upload_text(settings, "/user/key.pem", "KEY\n")
+
+
+def test_upload_text_checks_the_restriction(monkeypatch):
+    monkeypatch.setattr(pilot_module._dirac, "add_file", lambda *args: {"OK": True})
+    monkeypatch.setattr(
+        pilot_module._dirac,
+        "change_path_mode",
+        lambda *args: {
+            "OK": True,
+            "Value": {"Successful": {}, "Failed": {"/user/key.pem": "denied"}},
+        },
+    )
+    settings = pilot_module._dirac.DiracSettings("https://dirac.example.org")
+
+    with pytest.raises(RuntimeError, match="Could not restrict /user/key.pem"):
+        pilot_module.upload_text(settings, "/user/key.pem", "KEY\n", 0o600)
+
+    def chmod_file(settings, lfn, mode):
+        raise OSError("Operation not supported")
+
+    monkeypatch.setattr(
+        pilot_module._dirac,
+        "change_path_mode",
+        lambda *args: {"OK": True, "Value": {"Successful": {}, "Failed": {}}},
+    )
+    monkeypatch.setattr(pilot_module._dirac, "chmod_file", chmod_file)
+    with pytest.raises(RuntimeError, match="replica of /user/key.pem"):
+        pilot_module.upload_text(settings, "/user/key.pem", "KEY\n", 0o600)
+    pilot_module.upload_text(
+        settings, "/user/key.pem", "KEY\n", 0o600, allow_unrestricted_replica=True
+    )